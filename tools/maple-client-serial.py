@@ -18,14 +18,28 @@ from __future__ import print_function
 from cmd import Cmd
 from pprint import pprint  # For the readable stack printing.
 import argparse
+import asyncio
+import base64
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import glob
+import hashlib
+import json
 import logging
 import re
 import struct
 import sys
 import math
+import os
 import time
 import platform
 import select
+import threading
+import queue
+import weakref
+import zlib
 
 import serial
 
@@ -60,6 +74,19 @@ JERRY_DEBUGGER_WAIT_FOR_SOURCE = 24
 JERRY_DEBUGGER_OUTPUT_RESULT = 25
 JERRY_DEBUGGER_OUTPUT_RESULT_END = 26
 
+# Messages of the parsing of a source, fed to parse_source()
+JERRY_DEBUGGER_PARSE_MESSAGES = [JERRY_DEBUGGER_PARSE_ERROR,
+                                 JERRY_DEBUGGER_BYTE_CODE_CP,
+                                 JERRY_DEBUGGER_PARSE_FUNCTION,
+                                 JERRY_DEBUGGER_BREAKPOINT_LIST,
+                                 JERRY_DEBUGGER_BREAKPOINT_OFFSET_LIST,
+                                 JERRY_DEBUGGER_SOURCE_CODE,
+                                 JERRY_DEBUGGER_SOURCE_CODE_END,
+                                 JERRY_DEBUGGER_SOURCE_CODE_NAME,
+                                 JERRY_DEBUGGER_SOURCE_CODE_NAME_END,
+                                 JERRY_DEBUGGER_FUNCTION_NAME,
+                                 JERRY_DEBUGGER_FUNCTION_NAME_END]
+
 # Subtypes of eval
 JERRY_DEBUGGER_EVAL_EVAL = "\0"
 JERRY_DEBUGGER_EVAL_THROW = "\1"
@@ -98,7 +125,12 @@ JERRY_DEBUGGER_EVAL_PART = 18
 
 MAX_BUFFER_SIZE = 128
 WEBSOCKET_BINARY_FRAME = 2
+WEBSOCKET_CLOSE_FRAME = 8
 WEBSOCKET_FIN_BIT = 0x80
+WEBSOCKET_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+# Default port of the JerryScript WebSocket debugger server
+WEBSOCKET_PORT = 5001
 
 # Target types
 TARGET_FILE_DEPLOY = 1
@@ -110,20 +142,179 @@ TARGET_START_DEBUGGER = 6
 TARGET_CONFIG_DEPLOY = 7
 TARGET_STOP_ENGINE = 8
 TARGET_DEVICE_RESTART = 9
+TARGET_BAUD_RATE = 10
+TARGET_DEPLOY_CHUNK = 11
+TARGET_DEPLOY_HASH = 12
+
+# Targets whose frames carry a payload checksum. The target answers the
+# client extensions (TARGET_BAUD_RATE, ...) with frames in the same format.
+CHECKSUM_TARGETS = [TARGET_FILE_DEPLOY, TARGET_BAUD_RATE, TARGET_DEPLOY_CHUNK, TARGET_DEPLOY_HASH]
+
+# Operations of TARGET_DEPLOY_CHUNK frames
+DEPLOY_BEGIN = 1
+DEPLOY_DATA = 2
+DEPLOY_ACK = 3
+DEPLOY_NAK = 4
+DEPLOY_END = 5
+
+# Encodings of the deployed file in a windowed deploy. Deflate streams
+# are raw (no zlib header) with a 2^DEPLOY_DEFLATE_WBITS byte window, so
+# the target inflates them with a 512 byte history buffer.
+DEPLOY_RAW = 0
+DEPLOY_DEFLATE = 1
+DEPLOY_DEFLATE_WBITS = 9
+
+# Types of the file of a windowed deploy. The engine runs scripts and
+# snapshots, assets are only stored.
+DEPLOY_SCRIPT = 0
+DEPLOY_SNAPSHOT = 1
+DEPLOY_ASSET = 2
+DEPLOY_FILE_TYPES = {"script": DEPLOY_SCRIPT, "snapshot": DEPLOY_SNAPSHOT, "asset": DEPLOY_ASSET}
+
+# First bytes of a JerryScript snapshot (JERRY_SNAPSHOT_MAGIC)
+SNAPSHOT_MAGIC = b"JRRY"
+
+# Largest reply frame accepted from the target
+MAX_REPLY_SIZE = 256
+
+# UART speed used by the target after reset
+DEFAULT_BAUDRATE = 115200
+
+# Time to wait for the target to answer a baud rate change
+NEGOTIATE_TIMEOUT = 1
+
+# Windowed deploy: chunk size limits, the time to wait for an answer
+# before the chunks in flight are sent again and the retries per chunk
+MIN_DEPLOY_CHUNK = 64
+MAX_DEPLOY_CHUNK = 1024
+DEPLOY_TIMEOUT = 1
+DEPLOY_RETRIES = 5
+
+# Times a lost port is reopened during one windowed deploy
+DEPLOY_RECONNECTS = 5
+
+# Largest file of a TARGET_FILE_DEPLOY frame, its size field has 16 bits
+MAX_FILE_DEPLOY = 0xFFFF
+
+# Content hashes of the last verified deploy per target
+DEPLOY_CACHE = os.path.join(os.path.expanduser("~"), ".maplejs", "deploy-cache.json")
+
+# Seconds the deploy cache remembers that a target ignored the deploy
+# extensions, the target is probed again afterwards (firmware update)
+STOCK_FIRMWARE_TIMEOUT = 24 * 3600
 
 # Maximum waiting connection time
 MAX_WAIT_TIME = 15
 
+# Timeout of a single UART read
+READ_TIMEOUT = 1
+
+# Delay between two attempts to reopen a lost port
+RECONNECT_INTERVAL = 0.5
+
+# Time the main loop waits for a frame before checking the keyboard again
+POLL_INTERVAL = 0.05
+
+# Time a board gets to answer a command sent to the whole fleet
+FLEET_TIMEOUT = 5
+
+# Scripts whose functions are kept for reuse by FunctionCache
+FUNCTION_CACHE_SIZE = 16
+
+# Protocol trace capture
+TRACE_MAGIC = b"MJTRACE1"
+TRACE_INBOUND = 0
+TRACE_OUTBOUND = 1
+
+# Active ProtocolTracer, None when tracing is disabled. Frame handling code
+# only tests this variable, so a disabled trace costs nothing.
+tracer = None
+
+
+def add_common_arguments(parser, subcommand=False):
+    # The options are accepted before and after a subcommand. The defaults
+    # are only set by the main parser, the defaults of a subcommand parser
+    # would overwrite the values given before the subcommand.
+    def default(value):
+        return argparse.SUPPRESS if subcommand else value
+
+    parser.add_argument("--baud", action="store", default=default(DEFAULT_BAUDRATE), type=int,
+                        help="set the UART baud rate (default: %d)" % (DEFAULT_BAUDRATE))
+    parser.add_argument("--deploy-mode", action="store", default=default("window"),
+                        choices=["window", "packet", "once"],
+                        help="upload with acknowledged chunks (falls back to 'packet' on older targets), "
+                             "with fixed delays between the chunks, or in one write (default: window)")
+    parser.add_argument("--deploy-compression", action="store", default=default("deflate"),
+                        choices=["deflate", "none"],
+                        help="compress the file of a windowed deploy if the target can inflate it "
+                             "(default: deflate)")
+    parser.add_argument("--deploy-cache", action="store", default=default(DEPLOY_CACHE), metavar="FILE",
+                        help="skip the upload if the target already runs the file, hashes of "
+                             "earlier deploys are kept in FILE (default: %s)" % (DEPLOY_CACHE))
+    parser.add_argument("--force-upload", action="store_true", default=default(False),
+                        help="upload even if the target already runs the file")
+    parser.add_argument("--negotiate-baud", action="store", default=default(None), type=int, metavar="RATE",
+                        help="switch both sides to RATE after connecting, "
+                             "keep the --baud rate if the target does not confirm it")
+    parser.add_argument("-v", "--verbose", action="store_true", default=default(False),
+                        help="increase verbosity (default: False)")
+    parser.add_argument("--trace", action="store", default=default(None), metavar="FILE",
+                        help="capture every frame exchanged with the target into FILE")
+    parser.add_argument("--trace-ring", action="store", default=default(0), type=int, metavar="N",
+                        help="with --trace, keep only the last N frames in memory and "
+                             "write them when the client exits")
+
 
 def arguments_parse():
     parser = argparse.ArgumentParser(description="JerryScript debugger client")
-
-    parser.add_argument("--uart", action="store", default=None,
-                        help="specify a COM port")
+    commands = parser.add_subparsers(dest="command", metavar="command")
+
+    deploy = commands.add_parser("deploy", help="upload one script to several boards at once",
+                                 description="Upload one script to several boards at once")
+    deploy.add_argument("file", help="script to upload")
+    deploy.add_argument("ports", nargs="+", metavar="port",
+                        help="COM port, socket://host:port or a glob such as /dev/ttyUSB*")
+    deploy.add_argument("-j", "--jobs", action="store", default=None, type=int,
+                        help="upload to at most JOBS boards at a time (default: all)")
+    # The main parser sets the default of --file-type.
+    deploy.add_argument("--file-type", action="store", default=argparse.SUPPRESS,
+                        choices=["auto"] + sorted(DEPLOY_FILE_TYPES),
+                        help="type of the uploaded file, 'auto' tells snapshots, scripts and binary "
+                             "assets apart by their content (default: auto)")
+    add_common_arguments(deploy, True)
+
+    bundle = commands.add_parser("bundle", help="provision a board: upload several scripts and a config, then run them",
+                                 description="Stop the engine, upload several scripts (joined into the one script "
+                                             "the target runs) and a config blob, then run the scripts")
+    bundle.add_argument("port", help="COM port or socket://host:port")
+    bundle.add_argument("scripts", nargs="+", metavar="script", help="scripts to upload, in this order")
+    bundle.add_argument("--config", action="store", default=None, metavar="FILE",
+                        help="config blob sent with TARGET_CONFIG_DEPLOY")
+    add_common_arguments(bundle, True)
+
+    run = commands.add_parser("run", help="upload a script, start it and print its output",
+                              description="Upload a script, start it and print its output on the same "
+                                          "port, with the time spent in each phase")
+    run.add_argument("port", help="COM port or socket://host:port")
+    run.add_argument("script", help="script to run")
+    run.add_argument("--tail", action="store", default=None, type=float, metavar="SECONDS",
+                     help="stop printing the output after SECONDS (default: until interrupted)")
+    run.add_argument("--color", action="store_true", default=argparse.SUPPRESS,
+                     help="enable color highlighting of the output (default: False)")
+    add_common_arguments(run, True)
+
+    parser.add_argument("--uart", action="append", default=None,
+                        help="specify a COM port, socket://host:port (raw stream, e.g. a --bridge) "
+                             "or ws://host[:port][/path] (WebSocket debugger server), "
+                             "repeat it to debug several boards at once")
+    parser.add_argument("--bridge", action="store", default=None, type=int, metavar="PORT",
+                        help="relay the --uart port to one debugger client at a time on TCP PORT")
     parser.add_argument("--upload", action="store", default=None,
                         help="specify a filename and a COM port via --uart=port")
-    parser.add_argument("-v", "--verbose", action="store_true", default=False,
-                        help="increase verbosity (default: %(default)s)")
+    parser.add_argument("--file-type", action="store", default="auto", choices=["auto"] + sorted(DEPLOY_FILE_TYPES),
+                        help="type of the --upload file, 'auto' tells snapshots, scripts and binary "
+                             "assets apart by their content (default: %(default)s)")
+    add_common_arguments(parser)
     parser.add_argument("--non-interactive", action="store_true", default=False,
                         help="disable stop when newline is pressed (default: %(default)s)")
     parser.add_argument("--color", action="store_true", default=False,
@@ -132,6 +323,11 @@ def arguments_parse():
                         help="set display range")
     parser.add_argument("--exception", action="store", default=None, type=int, choices=[0, 1],
                         help="set exception config, usage 1: [Enable] or 0: [Disable]")
+    parser.add_argument("--session", action="store", default=None, metavar="FILE",
+                        help="restore the breakpoints, display range and exception config saved in "
+                             "FILE when the target is attached, and keep FILE up to date")
+    parser.add_argument("--dump-trace", action="store", default=None, metavar="FILE",
+                        help="print a capture written by --trace and exit")
 
     args = parser.parse_args()
 
@@ -144,6 +340,7 @@ def arguments_parse():
 
 
 class JerryBreakpoint(object):
+    __slots__ = ("line", "offset", "function", "active_index")
 
     def __init__(self, line, offset, function):
         self.line = line
@@ -183,12 +380,37 @@ class JerryPendingBreakpoint(object):
         return result
 
 
+class JerrySource(object):
+    # The text of a parsed script, shared by all of its functions, see
+    # JerryDebuggerBase.intern_source(). The text is split into lines on
+    # first use, most scripts are never listed.
+    __slots__ = ("name", "text", "_lines", "__weakref__")
+
+    def __init__(self, name, text):
+        self.name = name
+        self.text = text
+        self._lines = None
+
+    @property
+    def lines(self):
+        if self._lines is None:
+            self._lines = re.split("\r\n|[\r\n]", self.text)
+
+            if len(self._lines) > 1 and not self._lines[-1]:
+                self._lines.pop()
+        return self._lines
+
+
 class JerryFunction(object):
-    def __init__(self, is_func, byte_code_cp, source, source_name, line, column, name, lines, offsets):
+    __slots__ = ("is_func", "byte_code_cp", "script", "source_name", "name", "lines", "offsets",
+                 "sorted_offsets", "line", "column", "first_breakpoint_line", "first_breakpoint_offset")
+
+    def __init__(self, is_func, byte_code_cp, script, line, column, name, lines, offsets):
+        # 'script' is the JerrySource of the function.
         self.is_func = is_func
         self.byte_code_cp = byte_code_cp
-        self.source = re.split("\r\n|[\r\n]", source)
-        self.source_name = source_name
+        self.script = script
+        self.source_name = script.name
         self.name = name
         self.lines = {}
         self.offsets = {}
@@ -197,15 +419,31 @@ class JerryFunction(object):
         self.first_breakpoint_line = lines[0]
         self.first_breakpoint_offset = offsets[0]
 
-        if len(self.source) > 1 and not self.source[-1]:
-            self.source.pop()
-
         for i, line in enumerate(lines):
             offset = offsets[i]
             breakpoint = JerryBreakpoint(line, offset, self)
             self.lines[line] = breakpoint
             self.offsets[offset] = breakpoint
 
+        # For the nearest offset lookup of get_breakpoint()
+        self.sorted_offsets = sorted(self.offsets)
+
+    def matches(self, is_func, line, column, name, lines, offsets):
+        return (self.is_func == is_func and self.line == line and self.column == column and
+                self.name == name and list(self.lines) == lines and list(self.offsets) == offsets)
+
+    def rebind(self, byte_code_cp):
+        # The function is parsed again and gets a new byte code, its
+        # breakpoints are not set in the new byte code.
+        self.byte_code_cp = byte_code_cp
+        for breakpoint in self.lines.values():
+            breakpoint.active_index = -1
+
+    @property
+    def source(self):
+        # The lines of the script
+        return self.script.lines
+
     def __repr__(self):
         result = ("Function(byte_code_cp:0x%x, source_name:%r, name:%r, line:%d, column:%d { "
                   % (self.byte_code_cp, self.source_name, self.name, self.line, self.column))
@@ -226,6 +464,8 @@ class DebuggerPrompt(Cmd):
         self.cont = True
         self.non_interactive = False
         self.client_sources = []
+        # SessionFile of --session
+        self.session = None
 
     def precmd(self, line):
         self.stop = False
@@ -235,6 +475,9 @@ class DebuggerPrompt(Cmd):
         return line
 
     def postcmd(self, stop, line):
+        # 'quit' deletes the breakpoints, the session keeps them.
+        if self.session is not None and not self.quit:
+            self.session.save(self.debugger.session_state())
         return self.stop
 
     def do_quit(self, args):
@@ -343,8 +586,8 @@ class DebuggerPrompt(Cmd):
             print("Error: Breakpoint index expected")
             return
         elif args == "all":
-            self.debugger.delete_active()
-            self.debugger.delete_pending()
+            self.debugger.clear_breakpoints()
+
         elif args == "pending":
             self.debugger.delete_pending()
         elif args == "active":
@@ -383,13 +626,7 @@ class DebuggerPrompt(Cmd):
                       (val_errno))
                 return
 
-        message = struct.pack(self.debugger.byte_order + "BBIB" + self.debugger.idx_format,
-                              WEBSOCKET_BINARY_FRAME | WEBSOCKET_FIN_BIT,
-                              WEBSOCKET_FIN_BIT + 1 + 4,
-                              0,
-                              JERRY_DEBUGGER_GET_BACKTRACE,
-                              max_depth)
-        self.debugger.send_message(message)
+        self.debugger.send_backtrace(max_depth)
         self.stop = True
 
     do_bt = do_backtrace
@@ -454,51 +691,7 @@ class DebuggerPrompt(Cmd):
         pprint(self.debugger.function_list)
 
     def _send_string(self, args, message_type):
-        size = len(args)
-
-        # 1: length of type byte
-        # 4: length of an uint32 value
-        message_header = 1 + 4
-        max_fragment = min(self.debugger.max_message_size -
-                           message_header, size)
-
-        message = struct.pack(self.debugger.byte_order + "BBIBI",
-                              WEBSOCKET_BINARY_FRAME | WEBSOCKET_FIN_BIT,
-                              WEBSOCKET_FIN_BIT + max_fragment + message_header,
-                              0,
-                              message_type,
-                              size)
-
-        if size == max_fragment:
-            self.debugger.send_message(message + args)
-            self.stop = True
-            return
-
-        self.debugger.send_message(message + args[0:max_fragment])
-        offset = max_fragment
-
-        if message_type == JERRY_DEBUGGER_EVAL:
-            message_type = JERRY_DEBUGGER_EVAL_PART
-        else:
-            message_type = JERRY_DEBUGGER_CLIENT_SOURCE_PART
-
-        # 1: length of type byte
-        message_header = 1
-
-        max_fragment = self.debugger.max_message_size - message_header
-        while offset < size:
-            next_fragment = min(max_fragment, size - offset)
-
-            message = struct.pack(self.debugger.byte_order + "BBIB",
-                                  WEBSOCKET_BINARY_FRAME | WEBSOCKET_FIN_BIT,
-                                  WEBSOCKET_FIN_BIT + next_fragment + message_header,
-                                  0,
-                                  message_type)
-
-            prev_offset = offset
-            offset += next_fragment
-            self.debugger.send_message(message + args[prev_offset:offset])
-
+        self.debugger.send_string(args, message_type)
         self.stop = True
 
     def do_eval(self, args):
@@ -550,6 +743,9 @@ class DebuggerPrompt(Cmd):
 
 
 class Multimap(object):
+    # The values of a key are the keys of an insertion ordered dict, so
+    # inserting and deleting a value takes constant time, even if thousands
+    # of values share the key.
 
     def __init__(self):
         self.map = {}
@@ -559,38 +755,294 @@ class Multimap(object):
 
     def get(self, key):
         if key in self.map:
-            return self.map[key]
+            return list(self.map[key])
         return []
 
     def insert(self, key, value):
         if key in self.map:
-            self.map[key].append(value)
+            self.map[key][value] = None
         else:
-            self.map[key] = [value]
+            self.map[key] = {value: None}
 
     def delete(self, key, value):
         items = self.map[key]
+        del items[value]
 
-        if len(items) == 1:
+        if not items:
             del self.map[key]
-        else:
-            del items[items.index(value)]
 
 
-class JerrySerialDebugger(object):
-    def __init__(self, com_port):
-        self.com_port = com_port        # need to add baudrate, etc settings
-        self.serial = serial.Serial(
-            self.com_port, 115200, timeout=MAX_WAIT_TIME)
-        self.data = b''
+def source_suffixes(source_name):
+    # The names a 'file:line' location may use for a source: the full name
+    # and every path suffix after a '/' or '\' separator.
+    yield source_name
+
+    for match in re.finditer("[/\\\\]", source_name):
+        yield source_name[match.end():]
+
+
+class ProtocolTracer(object):
+    # Timestamped binary capture of the frames exchanged with the target.
+    #
+    # The capture file starts with TRACE_MAGIC, then one record per frame:
+    #   timestamp [8] - double, seconds since the start of the capture
+    #   direction [1] - TRACE_INBOUND or TRACE_OUTBOUND
+    #   target [1]    - target type of the envelope
+    #   size [2]      - frame length
+    #   frame [size]  - debugger frame (from the websocket header) or target payload
+    #
+    # With a ring size only the last 'ring_size' records are kept in memory
+    # and written by close(), otherwise every record goes to the file.
+
+    record_header = struct.Struct("<dBBH")
+
+    def __init__(self, path, ring_size=0):
+        self.file = open(path, "wb")
+        self.file.write(TRACE_MAGIC)
+        self.start = time.time()
+        self.lock = threading.Lock()
+        self.ring = None
+        if ring_size > 0:
+            self.ring = collections.deque(maxlen=ring_size)
+
+    def record(self, direction, target, frame):
+        record = self.record_header.pack(time.time() - self.start, direction, target,
+                                         len(frame)) + bytes(frame)
+        if self.ring is not None:
+            self.ring.append(record)
+            return
+
+        with self.lock:
+            self.file.write(record)
+
+    def close(self):
+        with self.lock:
+            if self.ring is not None:
+                self.file.write(b"".join(self.ring))
+                self.ring.clear()
+            self.file.close()
+
+
+class HandshakeScanner(object):
+    # Connection handshake state machine. The target announces itself with
+    # '@@' followed by the JERRY_DEBUGGER_CONFIGURATION frame. Bulk reads are
+    # scanned for the sync pattern first, then handed to the frame assembler,
+    # which keeps the bytes after the configuration for the session.
+
+    def __init__(self, assembler, synced=False):
+        # 'synced' skips the '@@' search on links without the announcement.
+        self.assembler = assembler
+        self.synced = synced
+        self.pending = b""
+
+    def feed(self, data):
+        # Returns the configuration frame once it is complete, None before.
+        if not self.synced:
+            data = self.pending + data
+            loc = data.find(b"@@")
+            if loc == -1:
+                # The first '@' may be the last byte of this read.
+                self.pending = data[-1:] if data.endswith(b"@") else b""
+                if self.assembler.console is not None:
+                    self.assembler.console += data[:len(data) - len(self.pending)]
+                return None
+
+            self.synced = True
+            if self.assembler.console is not None:
+                self.assembler.console += data[:loc]
+            data = data[loc + 2:]
+
+        self.assembler.feed(data)
+        for frame in self.assembler.frames():
+            if frame[2] == JERRY_DEBUGGER_CONFIGURATION:
+                return bytes(frame)
+            logging.debug("Frame before the configuration dropped")
+
+        return None
+
+
+class FrameAssembler(object):
+    # Reassembles debugger frames from the raw UART byte stream.
+    #
+    # Debugger frames are wrapped in the target envelope:
+    #   7E (escape), 02 (target: debugger), 82 (websocket header), size, payload
+    # Reply frames of the targets listed in 'reply_targets' have the
+    # construct_msg() format and are collected, with a valid checksum only,
+    # as (target, payload) pairs in 'replies'.
+    # Everything else on the line (console output, noise) is skipped, or
+    # collected in 'console' if it is set to a bytearray.
+    #
+    # Incoming bytes are appended to one bytearray and every byte is scanned
+    # only once: 'cursor' points at the first byte which is not known to be
+    # noise or an already returned frame. Complete frames are returned as
+    # memoryview slices of the buffer, so no payload is copied.
+
+    def __init__(self, reply_targets=()):
+        self.buffer = bytearray()
+        self.cursor = 0
+        self.reply_targets = reply_targets
+        self.replies = collections.deque()
+        self.console = None
+
+    def __len__(self):
+        return len(self.buffer) - self.cursor
+
+    def feed(self, data):
+        if not data:
+            return
+
+        try:
+            # Drop the consumed prefix in place (cheap for bytearrays).
+            del self.buffer[:self.cursor]
+            self.buffer += data
+        except BufferError:
+            # Returned frames are still referenced, so the old buffer must
+            # stay intact: continue with a fresh one holding the unread tail.
+            self.buffer = self.buffer[self.cursor:] + data
+        self.cursor = 0
+
+    def skip(self, position):
+        # Moves the cursor over bytes which belong to no frame.
+        if self.console is not None:
+            self.console += self.buffer[self.cursor:position]
+        self.cursor = position
+
+    def next_frame(self):
+        buffer = self.buffer
+        end = len(buffer)
+
+        while self.cursor < end:
+            if self.reply_targets:
+                loc = buffer.find(b"\x7e", self.cursor)
+            else:
+                loc = buffer.find(b"\x7e\x02", self.cursor)
+
+            if loc == -1:
+                # Keep a trailing escape byte, the target may follow later.
+                if buffer[end - 1] == 0x7E:
+                    self.skip(end - 1)
+                else:
+                    self.skip(end)
+                return None
+
+            # Skip the noise before the frame, even if the frame is incomplete.
+            self.skip(loc)
+
+            if end < loc + 4:
+                return None
+
+            target = buffer[loc + 1]
+            if target != TARGET_DEBUGGER:
+                size = buffer[loc + 2] | (buffer[loc + 3] << 8)
+                if target not in self.reply_targets or size > MAX_REPLY_SIZE:
+                    self.skip(loc + 1)
+                    continue
+
+                frame_end = loc + 4 + size + 1
+                if end < frame_end:
+                    return None
+
+                payload = bytes(buffer[loc + 4:frame_end - 1])
+                if check_sum(payload, size) != buffer[frame_end - 1]:
+                    # A '~' in the console output, not a reply.
+                    self.skip(loc + 1)
+                    continue
+
+                if tracer is not None:
+                    tracer.record(TRACE_INBOUND, target, payload)
+
+                self.replies.append((target, payload))
+                self.cursor = frame_end
+                continue
+
+            if buffer[loc + 2] != WEBSOCKET_BINARY_FRAME | WEBSOCKET_FIN_BIT:
+                raise Exception("Unexpected data frame")
+
+            size = buffer[loc + 3]
+            if size == 0 or size >= 126:
+                raise Exception("Unexpected data frame")
 
-        self.message_data = b""
+            frame_end = loc + 4 + size
+            if end < frame_end:
+                return None
+
+            self.cursor = frame_end
+            frame = memoryview(buffer)[loc + 2:frame_end]
+
+            if tracer is not None:
+                tracer.record(TRACE_INBOUND, TARGET_DEBUGGER, frame)
+            return frame
+
+        return None
+
+    def frames(self):
+        while True:
+            frame = self.next_frame()
+            if frame is None:
+                return
+            yield frame
+
+
+class SerialReader(threading.Thread):
+    # Drains the UART in bulk on a background thread and queues the complete
+    # debugger frames, so the device is serviced even while the prompt is busy.
+    # A None item in the queue means the connection was closed, an exception
+    # item is re-raised by the consumer. Target replies go to 'replies',
+    # console output collected by the assembler to 'console'.
+
+    def __init__(self, port, assembler):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.port = port
+        self.assembler = assembler
+        self.frames = queue.Queue()
+        self.replies = queue.Queue()
+        self.console = queue.Queue()
+        self.running = True
+
+    def run(self):
+        try:
+            while self.running:
+                # The assembler may already hold frames received together
+                # with the handshake.
+                for frame in self.assembler.frames():
+                    self.frames.put(frame)
+
+                while self.assembler.replies:
+                    self.replies.put(self.assembler.replies.popleft())
+
+                if self.assembler.console:
+                    self.console.put(bytes(self.assembler.console))
+                    del self.assembler.console[:]
+
+                self.assembler.feed(self.port.read(max(self.port.in_waiting, 1)))
+
+            self.frames.put(None)
+        except (serial.SerialException, OSError) as val_errno:
+            logging.debug("Serial reader stopped: %s", val_errno)
+            self.frames.put(None)
+        except Exception as val_errno:
+            self.frames.put(val_errno)
+
+    def stop(self):
+        self.running = False
+        if hasattr(self.port, "cancel_read"):
+            self.port.cancel_read()
+
+
+class JerryDebuggerBase(object):
+    # Debugger state and the client -> target message encoders. The transport
+    # specific debugger classes derive from it and implement send_message().
+
+    def __init__(self):
         self.function_list = {}
         self.last_breakpoint_hit = None
         self.next_breakpoint_index = 0
         self.active_breakpoint_list = {}
         self.pending_breakpoint_list = {}
-        self.line_list = Multimap()
+        # Breakpoints by (source name suffix, line) and functions by name
+        self.line_index = Multimap()
+        self.name_index = Multimap()
         self.display = 0
         self.default_viewrange = 3
         self.green = ''
@@ -603,11 +1055,54 @@ class JerrySerialDebugger(object):
         self.src_offset = 0
         self.src_offset_diff = 0
         self.repeats_remain = 0
-
-        result = b""
-
-        len_expected = 7
-
+        self.exception_config = None
+        self.outbound = bytearray()
+        self.batch_depth = 0
+        self.prefix = ""
+        # Scripts of the live functions, keyed by name and text
+        self.sources = weakref.WeakValueDictionary()
+        # Functions of the recent scripts, reused when they are parsed again
+        self.function_cache = FunctionCache()
+        # SourceParser of the script being parsed
+        self.parser = None
+        # Messages split into several frames, see handle_message()
+        self.exception_string = b""
+        self.message = b""
+        self.backtrace_frames = []
+
+    def intern_source(self, name, text):
+        # Returns the JerrySource of a script, the functions of a script
+        # and the parses of the same script share one.
+        key = (name, text)
+        source = self.sources.get(key)
+
+        if source is None:
+            source = JerrySource(name, text)
+            self.sources[key] = source
+        return source
+
+    def add_function(self, function):
+        self.function_list[function.byte_code_cp] = function
+
+        for suffix in source_suffixes(function.source_name):
+            for line, breakpoint in function.lines.items():
+                self.line_index.insert((suffix, line), breakpoint)
+        if function.name:
+            self.name_index.insert(function.name, function)
+
+    def remove_function(self, function):
+        for suffix in source_suffixes(function.source_name):
+            for line, breakpoint in function.lines.items():
+                self.line_index.delete((suffix, line), breakpoint)
+        for breakpoint in function.lines.values():
+            if breakpoint.active_index >= 0:
+                del self.active_breakpoint_list[breakpoint.active_index]
+        if function.name:
+            self.name_index.delete(function.name, function)
+
+        del self.function_list[function.byte_code_cp]
+
+    def configure(self, config):
         # Debugger configurations, which has the following struct:
         # header [2] - opcode[1], size[1]
         # type [1]
@@ -615,66 +1110,17 @@ class JerrySerialDebugger(object):
         # cpointer_size [1]
         # little_endian [1]
         # version [1]
-
-        # unit test - invoke JerryVM ourselves
-        # 7E = escape character
-        # 02 = target (debugger)
-        # 02 = byte length
-        # 40 40 = @ @
-        # self.serial.write(bytearray.fromhex("7E 04 00 00"))
-
-        # COM port handshake for now
-        print(">>>Reboot your board first!<<<\nWaiting for UART connection...")
-        start = time.time()     # Time to start waiting handshake
-        while True:
-            result = self.serial.read(1)
-            if result == "@":
-                logging.debug(result)
-                result += self.serial.read(1)
-                if result[1] == "@":
-                    logging.debug(result)
-                    break
-            # If the wait time exceeds the maximum value, prompt timeout and exit
-            if time.time() - start >= MAX_WAIT_TIME:
-                print("UART connection timeout!")
-                quit()
-
-        # end of COM port handshake
-
-        result = b""
-
-        len_expected = 7
-        while len(result) < len_expected:
-            # result += self.serial.read(1)
-
-            read_char = self.serial.read(1)
-            logging.debug("read_char = %c", read_char)
-            if read_char == chr(0x7E):
-                logging.debug("Found Header")
-                read_char = self.serial.read(1)
-                if read_char == chr(0x02):
-                    logging.debug("For debugger")
-            else:
-                result += read_char
-
-            logging.debug(" ".join(hex(ord(n)) for n in result))
-
-        # if len_result != 0:
-        logging.debug(" ".join(hex(ord(n)) for n in result))
-
-        len_result = len(result)
-
         expected = struct.pack("BBB",
                                WEBSOCKET_BINARY_FRAME | WEBSOCKET_FIN_BIT,
                                5,
                                JERRY_DEBUGGER_CONFIGURATION)
-        if result[0:3] != expected:
+        if config[0:3] != expected:
             raise Exception("Unexpected configuration")
 
-        self.max_message_size = ord(result[3])
-        self.cp_size = ord(result[4])
-        self.little_endian = ord(result[5])
-        self.version = ord(result[6])
+        self.max_message_size = config[3]
+        self.cp_size = config[4]
+        self.little_endian = config[5]
+        self.version = config[6]
         if self.version != JERRY_DEBUGGER_VERSION:
             raise Exception("Incorrect debugger version from target: %d expected: %d" %
                             (self.version, JERRY_DEBUGGER_VERSION))
@@ -695,12 +1141,122 @@ class JerrySerialDebugger(object):
 
         logging.debug("Compressed pointer size: %d", self.cp_size)
 
-        if len_result > len_expected:
-            self.message_data = result[len_expected:]
+    def reset_session(self):
+        # The target restarted and all of its byte code is gone. Active
+        # breakpoints become pending ones, so they are set again as soon as
+        # the new functions are parsed, and the exception config is restored.
+        for breakpoint in self.active_breakpoint_list.values():
+            pending = JerryPendingBreakpoint(breakpoint.line, breakpoint.function.source_name)
+            pending.index = breakpoint.active_index
+            self.pending_breakpoint_list[pending.index] = pending
+
+        self.active_breakpoint_list.clear()
+        self.function_list.clear()
+        self.line_index = Multimap()
+        self.name_index = Multimap()
+        self.last_breakpoint_hit = None
+        self.parser = None
+        # A message cut off by the restart is never completed.
+        self.exception_string = b""
+        self.message = b""
+        self.backtrace_frames = []
 
-    def __del__(self):
-        # nothing needs to be done for serial port
-        return
+        if self.pending_breakpoint_list:
+            self.send_parser_config(1)
+
+        if self.exception_config is not None:
+            self.send_exception_config(self.exception_config)
+
+    def restart(self, config):
+        # A new configuration frame in the middle of a session: the board rebooted.
+        self.configure(config)
+        self.reset_session()
+        self.report("Target restarted, session restored")
+
+    def handle_message(self, data):
+        # Handles a frame of the target. Parse, release and restart frames
+        # update the session here, source requests are answered, messages
+        # split into several frames are collected. Returns None, or a
+        # (message type, result) pair once a message is complete:
+        #   JERRY_DEBUGGER_CONFIGURATION: None, the target restarted
+        #   JERRY_DEBUGGER_BREAKPOINT_HIT, JERRY_DEBUGGER_EXCEPTION_HIT:
+        #       (breakpoint, exact, exception string or None)
+        #   JERRY_DEBUGGER_BACKTRACE_END: list of breakpoints
+        #   JERRY_DEBUGGER_EVAL_RESULT_END, JERRY_DEBUGGER_OUTPUT_RESULT_END:
+        #       (subtype, text)
+        #   JERRY_DEBUGGER_MEMSTATS_RECEIVE: dict of the memory statistics
+        buffer_type = data[2]
+
+        if buffer_type in JERRY_DEBUGGER_PARSE_MESSAGES:
+            parse_source(self, data)
+
+        elif buffer_type == JERRY_DEBUGGER_WAITING_AFTER_PARSE:
+            self.send_command(JERRY_DEBUGGER_PARSER_RESUME)
+
+        elif buffer_type == JERRY_DEBUGGER_RELEASE_BYTE_CODE_CP:
+            release_function(self, data)
+
+        elif buffer_type == JERRY_DEBUGGER_WAIT_FOR_SOURCE:
+            # The client never sends sources over the debugger link, the
+            # target would wait for them forever.
+            self.send_command(JERRY_DEBUGGER_NO_MORE_SOURCES)
+
+        elif buffer_type == JERRY_DEBUGGER_CONFIGURATION:
+            self.restart(data)
+            return buffer_type, None
+
+        elif buffer_type in [JERRY_DEBUGGER_BREAKPOINT_HIT, JERRY_DEBUGGER_EXCEPTION_HIT]:
+            breakpoint_data = struct.unpack(self.byte_order + self.cp_format + self.idx_format, data[3:])
+
+            breakpoint = get_breakpoint(self, breakpoint_data)
+            self.last_breakpoint_hit = breakpoint[0]
+
+            exception_string = None
+            if buffer_type == JERRY_DEBUGGER_EXCEPTION_HIT:
+                exception_string = decode_string(self.exception_string)
+            self.exception_string = b""
+
+            return buffer_type, (breakpoint[0], breakpoint[1], exception_string)
+
+        elif buffer_type in [JERRY_DEBUGGER_EXCEPTION_STR, JERRY_DEBUGGER_EXCEPTION_STR_END]:
+            self.exception_string += data[3:]
+
+        elif buffer_type in [JERRY_DEBUGGER_BACKTRACE, JERRY_DEBUGGER_BACKTRACE_END]:
+            buffer_pos = 3
+            frame_size = self.cp_size + 4
+            while buffer_pos + frame_size <= len(data):
+                breakpoint_data = struct.unpack(self.byte_order + self.cp_format + self.idx_format,
+                                                data[buffer_pos: buffer_pos + frame_size])
+                self.backtrace_frames.append(get_breakpoint(self, breakpoint_data)[0])
+                buffer_pos += frame_size
+
+            if buffer_type == JERRY_DEBUGGER_BACKTRACE_END:
+                frames = self.backtrace_frames
+                self.backtrace_frames = []
+                return buffer_type, frames
+
+        elif buffer_type in [JERRY_DEBUGGER_EVAL_RESULT, JERRY_DEBUGGER_OUTPUT_RESULT]:
+            self.message += data[3:]
+
+        elif buffer_type in [JERRY_DEBUGGER_EVAL_RESULT_END, JERRY_DEBUGGER_OUTPUT_RESULT_END]:
+            result = (data[-1], decode_string(self.message + data[3:-1]))
+            self.message = b""
+            return buffer_type, result
+
+        elif buffer_type == JERRY_DEBUGGER_MEMSTATS_RECEIVE:
+            memory_stats = struct.unpack(self.byte_order + self.idx_format * 5,
+                                         data[3: 3 + 4 * 5])
+            return buffer_type, dict(zip(["allocated", "byte_code", "string", "object", "property"],
+                                         memory_stats))
+
+        else:
+            raise Exception("Unknown message")
+
+        return None
+
+    def report(self, text):
+        # Status lines go through here, a fleet session prefixes its port name.
+        print(self.prefix + text)
 
     def set_colors(self):
         self.nocolor = '\033[0m'
@@ -711,12 +1267,112 @@ class JerrySerialDebugger(object):
         self.yellow_bg = '\033[43m\033[30m'
         self.blue = '\033[94m'
 
+    def send_message(self, message):
+        # Frames are collected in 'outbound' and written by flush(), at once
+        # for all frames queued inside a batch().
+        if tracer is not None:
+            tracer.record(TRACE_OUTBOUND, TARGET_DEBUGGER, message)
+
+        self.outbound += b"\x7e\x02"
+        self.outbound += message
+
+        if not self.batch_depth:
+            self.flush()
+
+    def flush(self):
+        if self.outbound:
+            data = bytes(self.outbound)
+            del self.outbound[:]
+            self.write(data)
+
+    @contextlib.contextmanager
+    def batch(self):
+        self.batch_depth += 1
+        try:
+            yield
+        finally:
+            self.batch_depth -= 1
+            if not self.batch_depth:
+                self.flush()
+
+    def set_breakpoints(self, locations):
+        # Sets breakpoints on the given 'file:line' or function name locations
+        # with a single write. Returns the locations without a parsed match.
+        missing = []
+        with self.batch():
+            for location in locations:
+                if not set_breakpoint(self, location, True):
+                    missing.append(location)
+        return missing
+
+    def add_pending_breakpoint(self, location):
+        # Breakpoint on a 'file:line' or function name that is not parsed yet.
+        if not self.pending_breakpoint_list:
+            self.send_parser_config(1)
+
+        enable_breakpoint(self, pending_breakpoint(location))
+
+    def session_state(self):
+        # The breakpoint locations, display range and exception config saved
+        # by --session. Breakpoints that are set are saved by their
+        # 'file:line' location, like reset_session() keeps them.
+        breakpoints = list(self.active_breakpoint_list.items()) + list(self.pending_breakpoint_list.items())
+        breakpoints.sort(key=lambda item: item[0])
+        locations = []
+        seen = set()
+
+        for _, breakpoint in breakpoints:
+            if isinstance(breakpoint, JerryPendingBreakpoint) and not breakpoint.line:
+                location = breakpoint.function
+            elif isinstance(breakpoint, JerryPendingBreakpoint):
+                location = "%s:%d" % (breakpoint.source_name, breakpoint.line)
+            else:
+                location = "%s:%d" % (breakpoint.function.source_name, breakpoint.line)
+
+            if location not in seen:
+                seen.add(location)
+                locations.append(location)
+
+        return {"breakpoints": locations, "display": self.display, "exception": self.exception_config}
+
+    def restore_session(self, state):
+        # Applies a saved session_state(). The breakpoints are written to the
+        # target in one batch; the ones that are not parsed yet become pending
+        # and parse_source() sets them together with their functions.
+        self.display = state.get("display") or 0
+        locations = state.get("breakpoints", [])
+        pending = 0
+
+        with self.batch():
+            for location in locations:
+                if set_breakpoint(self, location, True):
+                    continue
+
+                if not self.pending_breakpoint_list:
+                    self.send_parser_config(1)
+
+                breakpoint = pending_breakpoint(location)
+                self.next_breakpoint_index += 1
+                breakpoint.index = self.next_breakpoint_index
+                self.pending_breakpoint_list[breakpoint.index] = breakpoint
+                pending += 1
+
+            if state.get("exception") is not None:
+                self.send_exception_config(state["exception"])
+
+        self.report("Session restored, %d breakpoints (%d pending)" % (len(locations), pending))
+
+    def clear_breakpoints(self):
+        with self.batch():
+            self.delete_active()
+            self.delete_pending()
+
     def delete_active(self):
-        for i in self.active_breakpoint_list.values():
-            breakpoint = self.active_breakpoint_list[i.active_index]
-            del self.active_breakpoint_list[i.active_index]
-            breakpoint.active_index = -1
-            self.send_breakpoint(breakpoint)
+        with self.batch():
+            for breakpoint in self.active_breakpoint_list.values():
+                breakpoint.active_index = -1
+                self.send_breakpoint(breakpoint)
+        self.active_breakpoint_list.clear()
 
     def delete_pending(self):
         if self.pending_breakpoint_list:
@@ -761,6 +1417,8 @@ class JerrySerialDebugger(object):
         self.send_message(message)
 
     def send_exception_config(self, enable):
+        self.exception_config = enable
+
         message = struct.pack(self.byte_order + "BBIBB",
                               WEBSOCKET_BINARY_FRAME | WEBSOCKET_FIN_BIT,
                               WEBSOCKET_FIN_BIT + 1 + 1,
@@ -778,241 +1436,1342 @@ class JerrySerialDebugger(object):
                               enable)
         self.send_message(message)
 
-    # UART version
-    def send_message(self, message):
-        size = len(message)
+    def send_backtrace(self, max_depth):
+        message = struct.pack(self.byte_order + "BBIB" + self.idx_format,
+                              WEBSOCKET_BINARY_FRAME | WEBSOCKET_FIN_BIT,
+                              WEBSOCKET_FIN_BIT + 1 + 4,
+                              0,
+                              JERRY_DEBUGGER_GET_BACKTRACE,
+                              max_depth)
+        self.send_message(message)
 
-        logging.debug("send_message : size = %d", size)
+    def send_string(self, args, message_type):
+        args = args.encode("utf-8")
+        size = len(args)
 
-        self.serial.write(bytearray.fromhex("7E 02"))
+        # 1: length of type byte
+        # 4: length of an uint32 value
+        message_header = 1 + 4
+        max_fragment = min(self.max_message_size - message_header, size)
 
-        while size > 0:
-            bytes_send = self.serial.write(bytearray(message))
+        message = struct.pack(self.byte_order + "BBIBI",
+                              WEBSOCKET_BINARY_FRAME | WEBSOCKET_FIN_BIT,
+                              WEBSOCKET_FIN_BIT + max_fragment + message_header,
+                              0,
+                              message_type,
+                              size)
 
-            logging.debug(" ".join(hex(ord(n)) for n in message))
-            logging.debug("send_message : bytes_send = %d", bytes_send)
+        if size == max_fragment:
+            self.send_message(message + args)
+            return
 
-            if bytes_send < size:
-                message = message[bytes_send:]
-            size -= bytes_send
+        self.send_message(message + args[0:max_fragment])
+        offset = max_fragment
 
-    # UART version
-    def get_message(self, blocking):
+        if message_type == JERRY_DEBUGGER_EVAL:
+            message_type = JERRY_DEBUGGER_EVAL_PART
+        else:
+            message_type = JERRY_DEBUGGER_CLIENT_SOURCE_PART
 
-        logging.debug("get_message")
+        # 1: length of type byte
+        message_header = 1
 
-        # Connection was closed
-        if self.message_data is None:
-            return None
+        max_fragment = self.max_message_size - message_header
+        while offset < size:
+            next_fragment = min(max_fragment, size - offset)
 
-        logging.debug("get_message2 : %d", blocking)
+            message = struct.pack(self.byte_order + "BBIB",
+                                  WEBSOCKET_BINARY_FRAME | WEBSOCKET_FIN_BIT,
+                                  WEBSOCKET_FIN_BIT + next_fragment + message_header,
+                                  0,
+                                  message_type)
 
-        while True:
-            logging.debug("get_message0")
-            if len(self.message_data) >= 2:
-                if ord(self.message_data[0]) != WEBSOCKET_BINARY_FRAME | WEBSOCKET_FIN_BIT:
-                    logging.debug("Unexpected data frame")
-                    logging.debug(self.message_data)
-                    logging.debug(" ".join(hex(ord(n))
-                                           for n in self.message_data))
-                    raise Exception("Unexpected data frame")
-
-                size = ord(self.message_data[1])
-                logging.debug("get_message1")
-                logging.debug("size : %d", size)
-                if size == 0 or size >= 126:
-                    raise Exception("Unexpected data frame")
-
-                if len(self.message_data) >= size + 2:
-                    result = self.message_data[0:size + 2]
-                    self.message_data = self.message_data[size + 2:]
-                    logging.debug("get_message -- got a frame: ")
-                    logging.debug(" " .join(hex(ord(n)) for n in result))
-                    return result
+            prev_offset = offset
+            offset += next_fragment
+            self.send_message(message + args[prev_offset:offset])
 
-            logging.debug("get_message2")
-            logging.debug(" ".join(hex(ord(n)) for n in self.data))
-
-            if self.data == '':
-                logging.debug("data is empty")
-                if not blocking:
-                    if self.serial.in_waiting == 0:
-                        return b''
-
-                self.data = self.serial.read(self.serial.in_waiting)
-
-            logging.debug("get_message3")
-            # see if there is data for debugger
-            if self.data.find(chr(0x7E) + chr(0x02)) != -1:
-                logging.debug("data for debugger:")
-                logging.debug(" ".join(hex(ord(n)) for n in self.data))
-                loc = self.data.find(chr(0x7E) + chr(0x02))
-                logging.debug(
-                    "myString.find - ESCAPE : %d loc = %d", len(self.data), loc)
-
-                if len(self.data) < loc + 4:
-                    data2 = self.serial.read(loc+4-len(self.data))
-                    logging.debug("just read: %d bytes... %d %d -> %d",
-                                  len(data2), loc, len(self.data), loc+4-len(self.data))
-                    self.data = self.data + data2
-
-                size = ord(self.data[loc+3])
-                logging.debug("size : %d", size)
-
-                if len(self.data) < loc+4+size:
-                    data2 = self.serial.read(loc+4+size-len(self.data))
-                    logging.debug("just read: %d bytes... %d %d -> %d",
-                                  len(data2), loc, len(self.data), loc+4-len(self.data))
-                    self.data = self.data + data2
-
-                logging.debug("first packet: data for debugger:")
-                logging.debug(" ".join(hex(ord(n))
-                                       for n in self.data[loc+2:loc+2+2+size]))
-
-                self.message_data += self.data[loc+2:loc+2+2+size]
-                logging.debug("len of first packet: %d",
-                              len(self.data[loc+2:loc+2+2+size]))
-
-                logging.debug("remaining packet: data for debugger:")
-                logging.debug(" ".join(hex(ord(n))
-                                       for n in self.data[loc+2+2+size:]))
-
-                self.data = self.data[loc+2+2+size:]
-
-                if self.data.find(chr(0x7E) + chr(0x02)) == -1 and self.data.find(chr(0x7E)) != -1:
-                    logging.debug("INFO 1 --> loc: %s | len: %s",
-                                    self.data.find(chr(0x7E)), len(self.data))
-                    if (self.data.find(chr(0x7E)) + 1) == len(self.data):
-                        self.data += self.serial.read(1)
 
-            else:
-                logging.debug("NOT myString.find - ESCAPE")
+class JerrySerialDebugger(JerryDebuggerBase):
 
-                if self.data.find(chr(0x7E)) != -1 and (self.data.find(chr(0x7E)) + 1) == len(self.data):
-                    logging.debug("INFO 2 --> loc: %s | len: %s",
-                                  self.data.find(chr(0x7E)), len(self.data))
-                    self.data += self.serial.read(1)
-                else:
-                    self.data = ''
+    def __init__(self, com_port, baudrate=DEFAULT_BAUDRATE, negotiate_rate=None, connection=None, console=False):
+        # 'connection' is an open UploadConnection to take over, the target
+        # was started through it. With 'console' the output of the target
+        # outside debugger frames is queued in 'reader.console'.
+        JerryDebuggerBase.__init__(self)
 
+        self.com_port = com_port
+        self.baudrate = baudrate
+        self.negotiate_rate = negotiate_rate
+        self.console = console
+        self.boot_log = b""
+        self.serial = None
+        self.reader = None
 
-def parse_source(debugger, data):
-    source_code = ""
-    source_code_name = ""
-    function_name = ""
-    stack = [{"line": 1,
-              "column": 1,
-              "name": "",
-              "lines": [],
-              "offsets": []}]
-    new_function_list = {}
+        # unit test - invoke JerryVM ourselves
+        # 7E = escape character
+        # 02 = target (debugger)
+        # 02 = byte length
+        # 40 40 = @ @
+        # self.serial.write(bytearray.fromhex("7E 04 00 00"))
 
-    while True:
-        if data is None:
+        if connection is not None:
+            self.connect(MAX_WAIT_TIME, connection)
             return
 
-        buffer_type = ord(data[2])
-        buffer_size = ord(data[1]) - 1
+        print(">>>Reboot your board first!<<<\nWaiting for UART connection...")
+        self.connect(MAX_WAIT_TIME)
+
+    def connect(self, timeout, connection=None):
+        # Opens the port and waits for the handshake of the target.
+        # serial_for_url() also accepts socket://host:port, e.g. a --bridge.
+        if connection is not None:
+            # Bytes already read through the connection stay in its assembler.
+            self.serial = connection.port
+            self.assembler = connection.assembler
+        else:
+            self.serial = serial.serial_for_url(self.com_port, self.baudrate, timeout=READ_TIMEOUT)
+            self.assembler = FrameAssembler([TARGET_BAUD_RATE])
 
-        logging.debug("Parser buffer type: %d, message size: %d",
-                      buffer_type, buffer_size)
+        if self.console:
+            self.assembler.console = bytearray()
 
-        if buffer_type == JERRY_DEBUGGER_PARSE_ERROR:
-            logging.error("Parser error!")
-            return
+        scanner = HandshakeScanner(self.assembler)
+        deadline = time.time() + timeout
 
-        elif buffer_type in [JERRY_DEBUGGER_SOURCE_CODE, JERRY_DEBUGGER_SOURCE_CODE_END]:
-            source_code += data[3:]
+        while True:
+            config = scanner.feed(self.serial.read(max(self.serial.in_waiting, 1)))
+            if config is not None:
+                break
 
-        elif buffer_type in [JERRY_DEBUGGER_SOURCE_CODE_NAME, JERRY_DEBUGGER_SOURCE_CODE_NAME_END]:
-            source_code_name += data[3:]
+            # If the wait time exceeds the maximum value, prompt timeout
+            if time.time() >= deadline:
+                self.serial.close()
+                raise Exception("UART connection timeout!")
 
-        elif buffer_type in [JERRY_DEBUGGER_FUNCTION_NAME, JERRY_DEBUGGER_FUNCTION_NAME_END]:
-            function_name += data[3:]
+        self.configure(config)
 
-        elif buffer_type == JERRY_DEBUGGER_PARSE_FUNCTION:
-            logging.debug("Source name: %s, function name: %s",
-                          source_code_name, function_name)
+        if self.console:
+            # What the target printed while it booted.
+            self.boot_log = bytes(self.assembler.console)
+            del self.assembler.console[:]
 
-            position = struct.unpack(debugger.byte_order + debugger.idx_format + debugger.idx_format,
-                                     data[3: 3 + 4 + 4])
+        self.reader = SerialReader(self.serial, self.assembler)
+        self.reader.start()
 
-            stack.append({"source": source_code,
-                          "source_name": source_code_name,
-                          "line": position[0],
-                          "column": position[1],
-                          "name": function_name,
-                          "lines": [],
-                          "offsets": []})
-            function_name = ""
+        if self.negotiate_rate:
+            negotiate_baudrate(self.serial, self.get_reply, self.negotiate_rate)
 
-        elif buffer_type in [JERRY_DEBUGGER_BREAKPOINT_LIST, JERRY_DEBUGGER_BREAKPOINT_OFFSET_LIST]:
-            name = "lines"
-            if buffer_type == JERRY_DEBUGGER_BREAKPOINT_OFFSET_LIST:
-                name = "offsets"
+    def reconnect(self):
+        # Reopens the port after it disappeared (USB reset, power cycle) and
+        # restores the session. Returns False if the target does not come back.
+        print("Connection lost, waiting for the target...")
+        self.close()
 
-            logging.debug("Breakpoint %s received", name)
+        deadline = time.time() + MAX_WAIT_TIME
+        while time.time() < deadline:
+            try:
+                self.connect(deadline - time.time())
+            except (serial.SerialException, OSError):
+                time.sleep(RECONNECT_INTERVAL)
+                continue
+            except Exception as val_errno:
+                logging.debug("Reconnect failed: %s", val_errno)
+                break
 
-            buffer_pos = 3
-            while buffer_size > 0:
-                line = struct.unpack(debugger.byte_order + debugger.idx_format,
-                                     data[buffer_pos: buffer_pos + 4])
-                stack[-1][name].append(line[0])
-                buffer_pos += 4
-                buffer_size -= 4
+            self.reset_session()
+            print("Reconnected to the target on %s" % (self.com_port))
+            return True
 
-        elif buffer_type == JERRY_DEBUGGER_BYTE_CODE_CP:
-            byte_code_cp = struct.unpack(debugger.byte_order + debugger.cp_format,
-                                         data[3: 3 + debugger.cp_size])[0]
+        return False
 
-            logging.debug("Byte code cptr received: {0x%x}", byte_code_cp)
+    def __del__(self):
+        # nothing needs to be done for serial port
+        return
 
-            func_desc = stack.pop()
+    # UART version
+    def write(self, data):
+        size = len(data)
 
-            # We know the last item in the list is the general byte code.
-            if len(stack) == 0:
-                func_desc["source"] = source_code
-                func_desc["source_name"] = source_code_name
-
-            function = JerryFunction(len(stack) != 0,
-                                     byte_code_cp,
-                                     func_desc["source"],
-                                     func_desc["source_name"],
-                                     func_desc["line"],
-                                     func_desc["column"],
-                                     func_desc["name"],
-                                     func_desc["lines"],
-                                     func_desc["offsets"])
-
-            new_function_list[byte_code_cp] = function
-
-            if len(stack) == 0:
-                logging.debug("Parse completed.")
-                break
+        while size > 0:
+            bytes_send = self.serial.write(data)
 
-        elif buffer_type == JERRY_DEBUGGER_RELEASE_BYTE_CODE_CP:
-            # Redefined functions are dropped during parsing.
-            byte_code_cp = struct.unpack(debugger.byte_order + debugger.cp_format,
-                                         data[3: 3 + debugger.cp_size])[0]
+            if bytes_send < size:
+                data = data[bytes_send:]
+            size -= bytes_send
 
-            if byte_code_cp in new_function_list:
-                del new_function_list[byte_code_cp]
-                debugger.send_bytecode_cp(byte_code_cp)
-            else:
-                release_function(debugger, data)
+    # UART version
+    def get_message(self, blocking, timeout=None):
+        # Returns the next debugger frame as a memoryview, b'' if no frame
+        # arrived in non-blocking mode (within 'timeout' seconds if given),
+        # or None if the connection is closed.
 
-        else:
-            logging.error("Parser error!")
-            return
+        # Connection was closed
+        if self.reader is None:
+            return None
 
-        data = debugger.get_message(True)
+        try:
+            if blocking:
+                frame = self.reader.frames.get()
+            else:
+                frame = self.reader.frames.get(timeout is not None, timeout)
+        except queue.Empty:
+            return b''
+
+        if frame is None:
+            self.reader = None
+        elif isinstance(frame, Exception):
+            raise frame
+        return frame
+
+    def get_reply(self, target, timeout):
+        # Returns the payload of the next 'target' reply, None on timeout.
+        deadline = time.time() + timeout
+
+        while self.reader is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
 
-    # Copy the ready list to the global storage.
-    debugger.function_list.update(new_function_list)
+            try:
+                reply_target, payload = self.reader.replies.get(True, remaining)
+            except queue.Empty:
+                break
 
+            if reply_target == target:
+                return payload
+
+        return None
+
+    def close(self):
+        if self.reader is not None:
+            self.reader.stop()
+            self.reader = None
+        self.serial.close()
+
+
+class UploadConnection(object):
+    # Port of the upload path. There is no SerialReader: replies of the
+    # extension targets are read on demand, and the port can be reopened
+    # after it was lost (USB reset, dropped network link).
+
+    def __init__(self, url, baudrate=DEFAULT_BAUDRATE):
+        self.url = url
+        self.baudrate = baudrate
+        self.port = None
+        self.assembler = None
+        # False once the target ignored a deploy extension frame, the
+        # legacy upload is used without probing it again.
+        self.extensions = True
+        # Bytes sent by the last upload, fewer than the file has if the
+        # windowed deploy sent it deflated.
+        self.sent_size = 0
+
+    def open(self, timeout=0):
+        # Retries for 'timeout' seconds while the port is missing.
+        deadline = time.time() + timeout
+        while True:
+            try:
+                self.port = serial.serial_for_url(self.url, self.baudrate, timeout=READ_TIMEOUT)
+                break
+            except (serial.SerialException, OSError):
+                if time.time() >= deadline:
+                    raise
+                time.sleep(RECONNECT_INTERVAL)
+
+        self.assembler = FrameAssembler([TARGET_BAUD_RATE, TARGET_DEPLOY_CHUNK, TARGET_DEPLOY_HASH])
+
+    def reopen(self):
+        self.close()
+        self.open(MAX_WAIT_TIME)
+
+    def get_reply(self, target, timeout):
+        return read_reply(self.port, self.assembler, target, timeout)
+
+    def close(self):
+        if self.port is not None:
+            try:
+                self.port.close()
+            except (serial.SerialException, OSError):
+                pass
+            self.port = None
+
+
+class DeployCache(object):
+    # SHA-256 of the last verified deploy per target, keyed by the identity
+    # the target reports or by the port name, and the ports of targets
+    # without the deploy extensions (stock firmware) with the time they
+    # were found, stored as a JSON file.
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.stock = {}
+        self.lock = threading.Lock()
+
+        try:
+            with open(path, "r") as cache_file:
+                content = json.load(cache_file)
+        except (IOError, ValueError):
+            return
+
+        if "digests" in content:
+            self.entries = content["digests"]
+            self.stock = content.get("stock", {})
+        else:
+            # Written before the stock firmware ports were kept.
+            self.entries = content
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def put(self, key, digest):
+        with self.lock:
+            self.entries[key] = digest
+            self.save()
+
+    def is_stock(self, url):
+        # Whether the target on 'url' recently ignored the deploy extensions.
+        return time.time() - self.stock.get(url, 0) < STOCK_FIRMWARE_TIMEOUT
+
+    def set_stock(self, url):
+        with self.lock:
+            self.stock[url] = time.time()
+            self.save()
+
+    def save(self):
+        # Parallel uploads may read the file.
+        write_json(self.path, {"digests": self.entries, "stock": self.stock})
+
+
+def write_json(path, data):
+    # Replaces the file at once, a reader never sees a partial file.
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    temp_path = "%s.%d" % (path, os.getpid())
+    with open(temp_path, "w") as json_file:
+        json.dump(data, json_file, indent=1, sort_keys=True)
+    os.replace(temp_path, path)
+
+
+class SessionFile(object):
+    # The debug session state of --session, see session_state() of
+    # JerryDebuggerBase. The file is only written when the state changed.
+
+    def __init__(self, path):
+        self.path = path
+        self.saved = None
+
+    def load(self):
+        # Returns None if no session was saved yet.
+        try:
+            with open(self.path, "r") as session_file:
+                state = json.load(session_file)
+        except (IOError, ValueError):
+            return None
+
+        if not isinstance(state, dict):
+            return None
+
+        self.saved = state
+        return state
+
+    def save(self, state):
+        if state != self.saved:
+            write_json(self.path, state)
+            self.saved = state
+
+
+class AsyncSerialTransport(object):
+    # Asyncio byte transport over a serial device or a pty. The port is
+    # opened and configured by pyserial, then serviced by the event loop:
+    # reads and writes never block it, so one loop can drive many ports.
+    # Platforms without selectable serial handles (Windows) fall back to
+    # reading on the default executor.
+
+    def __init__(self, port, baudrate=DEFAULT_BAUDRATE):
+
+        self.port_name = port
+        self.baudrate = baudrate
+        self.port = None
+        self.fd = None
+        self.loop = None
+        self.received = bytearray()
+        self.pending = bytearray()
+        self.readable = None
+        self.drained = None
+        self.eof = False
+        self.synced = False
+
+    def __repr__(self):
+        return "AsyncSerialTransport(%r)" % (self.port_name)
+
+    async def open(self):
+        self.loop = asyncio.get_running_loop()
+        self.readable = asyncio.Event()
+        self.drained = asyncio.Event()
+        self.drained.set()
+
+        try:
+            self.port = serial.Serial(self.port_name, self.baudrate, timeout=0)
+            self.fd = self.port.fileno()
+        except AttributeError:
+            self.port.timeout = 0.1
+            self.fd = None
+
+        if self.fd is not None:
+            self.loop.add_reader(self.fd, self._read_ready)
+
+    def _read_ready(self):
+        try:
+            data = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            # EIO: the other end of the pty or the USB device is gone.
+            data = b""
+
+        if data:
+            self.received += data
+        else:
+            self.eof = True
+            self.loop.remove_reader(self.fd)
+        self.readable.set()
+
+    def _write_ready(self):
+        try:
+            written = os.write(self.fd, self.pending)
+        except BlockingIOError:
+            return
+        except OSError:
+            written = len(self.pending)
+            self.eof = True
+
+        del self.pending[:written]
+        if not self.pending:
+            self.loop.remove_writer(self.fd)
+            self.drained.set()
+
+    async def read(self):
+        # Returns everything received so far, b'' on end of file.
+        if self.fd is None:
+            while not self.eof:
+                data = await self.loop.run_in_executor(None, self.port.read, 4096)
+                if data:
+                    return data
+            return b""
+
+        while not self.received and not self.eof:
+            self.readable.clear()
+            await self.readable.wait()
+
+        data = bytes(self.received)
+        del self.received[:]
+        return data
+
+    def write(self, data):
+        if self.eof:
+            return
+
+        if self.fd is None:
+            self.port.write(data)
+            return
+
+        if not self.pending:
+            try:
+                written = os.write(self.fd, data)
+            except BlockingIOError:
+                written = 0
+
+            if written == len(data):
+                return
+
+            data = data[written:]
+            self.drained.clear()
+            self.loop.add_writer(self.fd, self._write_ready)
+
+        self.pending += data
+
+    async def drain(self):
+        await self.drained.wait()
+
+    def close(self):
+        if self.port is None:
+            return
+
+        if self.fd is not None:
+            self.loop.remove_reader(self.fd)
+            self.loop.remove_writer(self.fd)
+        self.eof = True
+        self.readable.set()
+        self.drained.set()
+        self.port.close()
+        self.port = None
+
+
+class AsyncTcpTransport(object):
+    # Asyncio transport for the raw UART byte stream relayed over TCP, e.g.
+    # by a client running with --bridge on the host the board is wired to.
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+        self.synced = False
+
+    def __repr__(self):
+        return "AsyncTcpTransport(%r, %d)" % (self.host, self.port)
+
+    async def open(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+    async def read(self):
+        # Returns everything received so far, b'' on end of file.
+        try:
+            return await self.reader.read(4096)
+        except ConnectionError:
+            return b""
+
+    def write(self, data):
+        self.writer.write(data)
+
+    async def drain(self):
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            pass
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+class AsyncWebSocketTransport(object):
+    # Asyncio transport for targets running the WebSocket debugger server of
+    # JerryScript. The debugger core works on the UART byte stream, so the
+    # frames are converted: incoming WebSocket frames get the 7E 02 target
+    # envelope and outgoing frames lose it. The server does not announce
+    # itself with '@@', the configuration is the first frame after the upgrade.
+
+    def __init__(self, host, port=WEBSOCKET_PORT, path="/jerry-debugger"):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.reader = None
+        self.writer = None
+        self.synced = True
+
+    def __repr__(self):
+        return "AsyncWebSocketTransport(%r, %d, %r)" % (self.host, self.port, self.path)
+
+    async def open(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+        key = base64.b64encode(os.urandom(16))
+        self.writer.write(b"GET %s HTTP/1.1\r\n"
+                          b"Host: %s:%d\r\n"
+                          b"Upgrade: websocket\r\n"
+                          b"Connection: Upgrade\r\n"
+                          b"Sec-WebSocket-Key: %s\r\n"
+                          b"Sec-WebSocket-Version: 13\r\n\r\n"
+                          % (self.path.encode("ascii"), self.host.encode("ascii"), self.port, key))
+
+        response = (await self.reader.readuntil(b"\r\n\r\n")).decode("latin-1").split("\r\n")
+        if not re.match("HTTP/1.1 101", response[0]):
+            raise Exception("WebSocket upgrade refused: %s" % (response[0]))
+
+        headers = {}
+        for line in response[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+
+        accept = base64.b64encode(hashlib.sha1(key + WEBSOCKET_GUID).digest()).decode("ascii")
+        if headers.get("sec-websocket-accept") != accept:
+            raise Exception("Invalid WebSocket handshake")
+
+    async def read(self):
+        # Returns the next frame in the target envelope, b'' on end of file.
+        try:
+            header = await self.reader.readexactly(2)
+            if header[0] & 0x0f == WEBSOCKET_CLOSE_FRAME:
+                return b""
+
+            size = header[1]
+            if size > 125:
+                raise Exception("Unsupported WebSocket frame")
+
+            payload = await self.reader.readexactly(size)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return b""
+
+        return b"\x7e\x02" + header + payload
+
+    def write(self, data):
+        # 'data' is a run of enveloped frames: 7E 02 82 (0x80 + size) mask payload
+        frames = bytearray()
+        pos = 0
+        while pos < len(data):
+            size = 2 + 4 + (data[pos + 3] & 0x7f)
+            frames += data[pos + 2: pos + 2 + size]
+            pos += 2 + size
+
+        self.writer.write(frames)
+
+    async def drain(self):
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            pass
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+def create_transport(url, baudrate=DEFAULT_BAUDRATE):
+    # Async transport for a --uart argument: a serial device, the raw byte
+    # stream over TCP (socket://host:port) or the WebSocket debugger server
+    # of JerryScript (ws://host[:port][/path]).
+    match = re.match("(socket|ws)://([^:/]+)(?::(\\d+))?(/.*)?$", url)
+    if not match:
+        return AsyncSerialTransport(url, baudrate)
+
+    if match.group(1) == "ws":
+        return AsyncWebSocketTransport(match.group(2), int(match.group(3) or WEBSOCKET_PORT),
+                                       match.group(4) or "/jerry-debugger")
+
+    if match.group(3) is None:
+        raise Exception("Port expected in %s" % (url))
+    return AsyncTcpTransport(match.group(2), int(match.group(3)))
+
+
+class AsyncJerryDebugger(JerryDebuggerBase):
+    # Asyncio debugger core on top of a pluggable transport (any object with
+    # the open/read/write/drain/close interface of AsyncSerialTransport, see
+    # create_transport() for the network ones).
+    #
+    # A reader task decodes the incoming frames: parse and release messages
+    # update the function tables, replies complete the pending request and
+    # breakpoint hits and target output are queued for the consumer:
+    #
+    #   dbg = AsyncJerryDebugger(AsyncSerialTransport("/dev/ttyUSB0"))
+    #   await dbg.connect()
+    #   breakpoint, exact = await dbg.wait_for_stop()
+    #   print(await dbg.eval("a + 1"))
+    #   async for subtype, message in dbg.output(): ...
+
+    def __init__(self, transport):
+        JerryDebuggerBase.__init__(self)
+        self.transport = transport
+        self.assembler = FrameAssembler()
+        self.replies = None
+        self.stops = None
+        self.outputs = None
+        self.request_lock = None
+        self.reader_task = None
+        self.closed = False
+
+    def __repr__(self):
+        return "AsyncJerryDebugger(%r)" % (self.transport)
+
+    async def connect(self, timeout=MAX_WAIT_TIME):
+        self.replies = asyncio.Queue()
+        self.stops = asyncio.Queue()
+        self.outputs = asyncio.Queue()
+        self.request_lock = asyncio.Lock()
+
+        await self.transport.open()
+
+        config = await asyncio.wait_for(self._handshake(), timeout)
+        self.configure(config)
+
+        self.reader_task = asyncio.ensure_future(self._reader())
+
+    async def _handshake(self):
+        scanner = HandshakeScanner(self.assembler, self.transport.synced)
+        while True:
+            data = await self.transport.read()
+            if not data:
+                raise Exception("Connection closed during handshake")
+
+            config = scanner.feed(data)
+            if config is not None:
+                return config
+
+    async def _read_frame(self):
+        while True:
+            frame = self.assembler.next_frame()
+            if frame is not None:
+                return frame
+
+            data = await self.transport.read()
+            if not data:
+                return None
+            self.assembler.feed(data)
+
+    async def _reader(self):
+        error = None
+        try:
+            while True:
+                frame = await self._read_frame()
+                if frame is None:
+                    break
+                self._dispatch(frame)
+        except asyncio.CancelledError:
+            pass
+        except Exception as val_errno:
+            logging.debug("Debugger reader stopped: %s", val_errno)
+            error = val_errno
+
+        self.closed = True
+        for waiters in (self.replies, self.stops, self.outputs):
+            waiters.put_nowait(error)
+
+    def send_message(self, message):
+        # Frames sent in the same loop iteration are written together.
+        if not self.outbound and not self.batch_depth:
+            asyncio.get_running_loop().call_soon(self.flush)
+
+        self.batch_depth += 1
+        JerryDebuggerBase.send_message(self, message)
+        self.batch_depth -= 1
+
+    def write(self, data):
+        self.transport.write(data)
+
+    def _dispatch(self, data):
+        event = self.handle_message(data)
+        if event is None:
+            return
+
+        buffer_type, result = event
+        if buffer_type in [JERRY_DEBUGGER_BREAKPOINT_HIT, JERRY_DEBUGGER_EXCEPTION_HIT]:
+            self.stops.put_nowait(result)
+        elif buffer_type == JERRY_DEBUGGER_OUTPUT_RESULT_END:
+            self.outputs.put_nowait(result)
+        elif buffer_type != JERRY_DEBUGGER_CONFIGURATION:
+            self.replies.put_nowait(event)
+
+    async def _get(self, waiters):
+        if self.closed and waiters.empty():
+            raise Exception("Connection closed")
+
+        item = await waiters.get()
+        if item is None or isinstance(item, Exception):
+            # Keep the end marker for the next waiter.
+            waiters.put_nowait(item)
+            raise item or Exception("Connection closed")
+        return item
+
+    def _drop_replies(self):
+        # Replies of the requests that timed out arrive late, they must not
+        # answer the next request.
+        while not self.replies.empty():
+            item = self.replies.get_nowait()
+            if item is None or isinstance(item, Exception):
+                self.replies.put_nowait(item)
+                return
+            logging.debug("Dropped late reply: %r", item)
+
+    async def _request(self, reply_type, send, *args):
+        # Sends a request and waits for its reply of the given message type.
+        async with self.request_lock:
+            self._drop_replies()
+            send(*args)
+            self.flush()
+            await self.transport.drain()
+
+            while True:
+                buffer_type, result = await self._get(self.replies)
+                if buffer_type == reply_type:
+                    return result
+                logging.debug("Dropped late reply: %r", (buffer_type, result))
+
+    async def eval(self, expression):
+        subtype, message = await self._request(JERRY_DEBUGGER_EVAL_RESULT_END,
+                                               self.send_string,
+                                               JERRY_DEBUGGER_EVAL_EVAL + expression,
+                                               JERRY_DEBUGGER_EVAL)
+        if subtype == JERRY_DEBUGGER_EVAL_ERROR:
+            raise Exception("Uncaught exception: %s" % (message))
+        return message
+
+    async def backtrace(self, max_depth=0):
+        return await self._request(JERRY_DEBUGGER_BACKTRACE_END, self.send_backtrace, max_depth)
+
+    async def memstats(self):
+        return await self._request(JERRY_DEBUGGER_MEMSTATS_RECEIVE, self.send_command,
+                                   JERRY_DEBUGGER_MEMSTATS)
+
+    async def set_breakpoint(self, location):
+        # Returns False if no parsed function matches the location yet.
+        found = set_breakpoint(self, location, True)
+        self.flush()
+        await self.transport.drain()
+        return found
+
+    async def set_breakpoints(self, locations):
+        missing = JerryDebuggerBase.set_breakpoints(self, locations)
+        await self.transport.drain()
+        return missing
+
+    async def clear_breakpoints(self):
+        JerryDebuggerBase.clear_breakpoints(self)
+        await self.transport.drain()
+
+    async def _execute(self, command):
+        self.send_command(command)
+        self.flush()
+        await self.transport.drain()
+
+    async def resume(self):
+        await self._execute(JERRY_DEBUGGER_CONTINUE)
+
+    async def step(self):
+        await self._execute(JERRY_DEBUGGER_STEP)
+
+    async def next(self):
+        await self._execute(JERRY_DEBUGGER_NEXT)
+
+    async def finish(self):
+        await self._execute(JERRY_DEBUGGER_FINISH)
+
+    async def stop(self):
+        await self._execute(JERRY_DEBUGGER_STOP)
+
+    async def wait_for_stop(self):
+        # Returns (breakpoint, exact match, exception hint or None).
+        return await self._get(self.stops)
+
+    async def output(self):
+        # Async iterator of (subtype, message) pairs printed by the target.
+        while True:
+            try:
+                yield await self._get(self.outputs)
+            except Exception:
+                return
+
+    async def close(self):
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+            try:
+                await self.reader_task
+            except asyncio.CancelledError:
+                pass
+            self.reader_task = None
+        self.transport.close()
+
+
+class SessionManager(object):
+    # Debugs a fleet of boards from one process: every port gets an
+    # AsyncJerryDebugger and all of them are driven by a single event loop
+    # running on a background thread. Output and breakpoint hits of each
+    # board are printed with its port name, commands fan out to all boards.
+
+    def __init__(self, ports, baudrate=DEFAULT_BAUDRATE):
+        self.ports = ports
+        self.baudrate = baudrate
+        # The loop thread and the prompt thread both use sessions and
+        # stopped, the lock guards them.
+        self.sessions = collections.OrderedDict()
+        self.stopped = {}
+        self.lock = threading.Lock()
+        self.watchers = []
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.daemon = True
+
+    def start(self, colors=False):
+        self.thread.start()
+        self.call(self._connect_all(colors))
+
+        if not self.connected_ports():
+            raise Exception("No target connected")
+
+    def call(self, coroutine):
+        # Runs a coroutine on the fleet loop and waits for its result.
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def _connect_all(self, colors):
+        debuggers = [AsyncJerryDebugger(create_transport(port, self.baudrate))
+                     for port in self.ports]
+        results = await asyncio.gather(*[debugger.connect() for debugger in debuggers],
+                                       return_exceptions=True)
+
+        for port, debugger, result in zip(self.ports, debuggers, results):
+            if isinstance(result, BaseException):
+                print("[%s] Connection failed: %s" % (port, result or "timeout"))
+                debugger.transport.close()
+                continue
+
+            debugger.prefix = "[%s] " % (port)
+            if colors:
+                debugger.set_colors()
+
+            with self.lock:
+                self.sessions[port] = debugger
+            self.watchers.append(asyncio.ensure_future(self._watch_output(debugger)))
+            self.watchers.append(asyncio.ensure_future(self._watch_stops(port, debugger)))
+            debugger.report("Connected")
+
+    async def _watch_output(self, debugger):
+        async for subtype, message in debugger.output():
+            message = output_message(debugger, subtype, message)
+            if message is not None:
+                debugger.report(message)
+
+    async def _watch_stops(self, port, debugger):
+        while True:
+            try:
+                breakpoint, exact, exception_string = await debugger.wait_for_stop()
+            except Exception:
+                break
+
+            if exception_string is not None:
+                debugger.report("Exception throw detected")
+                if exception_string:
+                    debugger.report("Exception hint: %s" % (exception_string))
+
+            with self.lock:
+                self.stopped[port] = breakpoint
+            debugger.report(stop_message(debugger, breakpoint, exact))
+
+        with self.lock:
+            self.stopped.pop(port, None)
+            self.sessions.pop(port, None)
+        debugger.report("Disconnected")
+
+    def states(self):
+        # Returns a list of (port, breakpoint or None if running) pairs.
+        with self.lock:
+            return [(port, self.stopped.get(port)) for port in self.sessions]
+
+    def connected_ports(self):
+        return [port for port, _ in self.states()]
+
+    def stopped_ports(self):
+        return [port for port, breakpoint in self.states() if breakpoint is not None]
+
+    def running_ports(self):
+        return [port for port, breakpoint in self.states() if breakpoint is None]
+
+    async def _fanout(self, action, ports):
+        with self.lock:
+            debuggers = [self.sessions.get(port) for port in ports]
+
+        async def run(debugger):
+            # The board disconnected since the ports were listed.
+            if debugger is None:
+                raise Exception("Disconnected")
+            return await asyncio.wait_for(action(debugger), FLEET_TIMEOUT)
+
+        results = await asyncio.gather(*[run(debugger) for debugger in debuggers],
+                                       return_exceptions=True)
+        return list(zip(ports, results))
+
+    def fanout(self, action, ports=None):
+        # Calls action(debugger) on the given boards (all by default) at the
+        # same time, returns a list of (port, result or exception) pairs.
+        if ports is None:
+            ports = self.connected_ports()
+        return self.call(self._fanout(action, ports))
+
+    def resume(self, action):
+        # Execution commands are only accepted by stopped boards.
+        results = self.fanout(action, self.stopped_ports())
+        with self.lock:
+            for port, _ in results:
+                self.stopped.pop(port, None)
+        return results
+
+    async def _close(self):
+        for watcher in self.watchers:
+            watcher.cancel()
+
+        with self.lock:
+            debuggers = list(self.sessions.values())
+            self.sessions.clear()
+            self.stopped.clear()
+
+        for debugger in debuggers:
+            await debugger.close()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.call(self._close())
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+
+
+class FleetPrompt(Cmd):
+
+    def __init__(self, manager):
+        Cmd.__init__(self)
+        self.manager = manager
+        self.quit = False
+        # SessionFile of --session
+        self.session = None
+
+    def emptyline(self):
+        pass
+
+    def postcmd(self, stop, line):
+        # The boards get the same commands, the session keeps the locations
+        # of all of them. 'quit' deletes the breakpoints, the session keeps them.
+        if self.session is None or self.quit:
+            return stop
+
+        async def snapshot(debugger):
+            return debugger.session_state()
+
+        state = None
+        for _, result in self.manager.fanout(snapshot):
+            if isinstance(result, Exception):
+                continue
+            if state is None:
+                state = result
+                seen = set(state["breakpoints"])
+
+            for location in result["breakpoints"]:
+                if location not in seen:
+                    seen.add(location)
+                    state["breakpoints"].append(location)
+
+        if state is not None:
+            self.session.save(state)
+        return stop
+
+    def _report(self, results, show=None):
+        # Prints the outcome of a fanned out command, one line per board.
+        if not results:
+            print("Error: No board is in the right state for this command")
+
+        for port, result in results:
+            if isinstance(result, asyncio.TimeoutError):
+                print("[%s] Error: No answer" % (port))
+            elif isinstance(result, Exception):
+                print("[%s] Error: %s" % (port, result))
+            elif show is not None:
+                show(port, result)
+
+    def do_sessions(self, args):
+        """ List the connected boards """
+        for port, breakpoint in self.manager.states():
+            if breakpoint is None:
+                print("[%s] running" % (port))
+            else:
+                print("[%s] stopped at %s" % (port, breakpoint))
+
+    def do_break(self, args):
+        """ Insert breakpoints on all boards, pending where not parsed yet """
+        if args == "":
+            print("Error: Breakpoint index expected")
+            return
+
+        async def insert(debugger):
+            if not await debugger.set_breakpoint(args):
+                debugger.add_pending_breakpoint(args)
+                await debugger.transport.drain()
+
+        self._report(self.manager.fanout(insert))
+
+    do_b = do_break
+
+    def do_delete(self, args):
+        """ Delete all breakpoints on all boards """
+        if args != "all":
+            print("Error: Only 'delete all' is supported on a fleet")
+            return
+
+        self._report(self.manager.fanout(lambda debugger: debugger.clear_breakpoints()))
+
+    def do_continue(self, args):
+        """ Continue execution on the stopped boards """
+        self._report(self.manager.resume(lambda debugger: debugger.resume()))
+
+    do_c = do_continue
+
+    def do_step(self, args):
+        """ Execute the next instruction on the stopped boards, step into functions """
+        self._report(self.manager.resume(lambda debugger: debugger.step()))
+
+    do_s = do_step
+
+    def do_next(self, args):
+        """ Execute the next instruction on the stopped boards """
+        self._report(self.manager.resume(lambda debugger: debugger.next()))
+
+    do_n = do_next
+
+    def do_finish(self, args):
+        """ Continue running the stopped boards until the current function returns """
+        self._report(self.manager.resume(lambda debugger: debugger.finish()))
+
+    do_f = do_finish
+
+    def do_stop(self, args):
+        """ Stop the running boards """
+        self._report(self.manager.fanout(lambda debugger: debugger.stop(),
+                                         self.manager.running_ports()))
+
+    def do_backtrace(self, args):
+        """ Get the backtrace of the stopped boards """
+        def show(port, frames):
+            for index, breakpoint in enumerate(frames):
+                print("[%s] Frame %d: %s" % (port, index, breakpoint))
+
+        self._report(self.manager.fanout(lambda debugger: debugger.backtrace(),
+                                         self.manager.stopped_ports()), show)
+
+    do_bt = do_backtrace
+
+    def do_eval(self, args):
+        """ Evaluate JavaScript source code on the stopped boards """
+        self._report(self.manager.fanout(lambda debugger: debugger.eval(args),
+                                         self.manager.stopped_ports()),
+                     lambda port, result: print("[%s] %s" % (port, result)))
+
+    do_e = do_eval
+
+    def do_exception(self, args):
+        """ Config the exception handler on all boards, 1: [Enable] or 0: [Disable] """
+        if args not in ["0", "1"]:
+            print("Error: 0 or 1 expected")
+            return
+
+        async def configure(debugger):
+            debugger.send_exception_config(int(args))
+            debugger.flush()
+            await debugger.transport.drain()
+
+        self._report(self.manager.fanout(configure))
+
+    def do_memstats(self, args):
+        """ Memory statistics of all boards """
+        def show(port, stats):
+            print("[%s] Allocated: %d, byte code: %d, string: %d, object: %d, property: %d"
+                  % (port, stats["allocated"], stats["byte_code"], stats["string"],
+                     stats["object"], stats["property"]))
+
+        self._report(self.manager.fanout(lambda debugger: debugger.memstats()), show)
+
+    do_ms = do_memstats
+
+    def do_quit(self, args):
+        """ Exit debugger, the boards continue running """
+        async def release(debugger):
+            await debugger.clear_breakpoints()
+            debugger.send_exception_config(0)
+            debugger.flush()
+            await debugger.transport.drain()
+
+        self.manager.fanout(release)
+        self.manager.resume(lambda debugger: debugger.resume())
+        self.quit = True
+        return True
+
+    do_EOF = do_quit
+
+
+class FunctionCache(object):
+    # The functions of the recently parsed scripts, keyed by source name and
+    # text; the dict key compares the text only on a matching hash. A board
+    # that reboots, or an eval of the same code, reports the functions of a
+    # script again in the same order, and a function that is not live is
+    # rebound to its new byte code instead of rebuilding its tables.
+
+    def __init__(self, size=FUNCTION_CACHE_SIZE):
+        self.size = size
+        self.scripts = collections.OrderedDict()
+
+    def get(self, source):
+        # Returns the list of the cached functions of 'source', in parse order.
+        key = (source.name, source.text)
+        functions = self.scripts.get(key)
+
+        if functions is None:
+            functions = []
+            self.scripts[key] = functions
+            if len(self.scripts) > self.size:
+                self.scripts.popitem(last=False)
+        else:
+            self.scripts.move_to_end(key)
+        return functions
+
+    def clear(self):
+        self.scripts.clear()
+
+
+class SourceParser(object):
+    # Incremental parser of the JERRY_DEBUGGER_PARSE_MESSAGES frames of one
+    # script: the frames are fed one at a time as they arrive, so a large
+    # script does not hold up the other messages. The source, source name
+    # and function name payloads are collected in bytearrays and the source
+    # is decoded once.
+
+    def __init__(self):
+        self.source_code = bytearray()
+        self.source_code_name = bytearray()
+        self.function_name = bytearray()
+        self.source = None
+        self.stack = [{"line": 1,
+                       "column": 1,
+                       "name": "",
+                       "lines": [],
+                       "offsets": []}]
+        self.new_function_list = {}
+        self.failed = False
+        # Cached functions of the script and the position of the next one
+        self.cached = None
+        self.position = 0
+
+    def get_source(self, debugger):
+        if self.source is None:
+            self.source = debugger.intern_source(decode_string(self.source_code_name),
+                                                 decode_string(self.source_code))
+        return self.source
+
+    def feed(self, debugger, data):
+        # Returns True once the parse is complete or failed.
+        buffer_type = data[2]
+        buffer_size = data[1] - 1
+
+        logging.debug("Parser buffer type: %d, message size: %d",
+                      buffer_type, buffer_size)
+
+        if buffer_type in [JERRY_DEBUGGER_SOURCE_CODE, JERRY_DEBUGGER_SOURCE_CODE_END]:
+            self.source_code += data[3:]
+            self.source = None
+
+        elif buffer_type in [JERRY_DEBUGGER_SOURCE_CODE_NAME, JERRY_DEBUGGER_SOURCE_CODE_NAME_END]:
+            self.source_code_name += data[3:]
+            self.source = None
+
+        elif buffer_type in [JERRY_DEBUGGER_FUNCTION_NAME, JERRY_DEBUGGER_FUNCTION_NAME_END]:
+            self.function_name += data[3:]
+
+        elif buffer_type == JERRY_DEBUGGER_PARSE_FUNCTION:
+            logging.debug("Source name: %s, function name: %s",
+                          self.source_code_name, self.function_name)
+
+            position = struct.unpack(debugger.byte_order + debugger.idx_format + debugger.idx_format,
+                                     data[3: 3 + 4 + 4])
+
+            self.stack.append({"source": self.get_source(debugger),
+                               "line": position[0],
+                               "column": position[1],
+                               "name": decode_string(self.function_name),
+                               "lines": [],
+                               "offsets": []})
+            self.function_name = bytearray()
+
+        elif buffer_type in [JERRY_DEBUGGER_BREAKPOINT_LIST, JERRY_DEBUGGER_BREAKPOINT_OFFSET_LIST]:
+            name = "lines"
+            if buffer_type == JERRY_DEBUGGER_BREAKPOINT_OFFSET_LIST:
+                name = "offsets"
+
+            logging.debug("Breakpoint %s received", name)
+
+            count = buffer_size // 4
+            self.stack[-1][name].extend(struct.unpack(debugger.byte_order + str(count) + debugger.idx_format,
+                                                      data[3: 3 + count * 4]))
+
+        elif buffer_type == JERRY_DEBUGGER_BYTE_CODE_CP:
+            byte_code_cp = struct.unpack(debugger.byte_order + debugger.cp_format,
+                                         data[3: 3 + debugger.cp_size])[0]
+
+            logging.debug("Byte code cptr received: {0x%x}", byte_code_cp)
+
+            func_desc = self.stack.pop()
+
+            # We know the last item in the list is the general byte code.
+            if len(self.stack) == 0:
+                func_desc["source"] = self.get_source(debugger)
+
+            function = self.reuse_function(debugger, byte_code_cp, func_desc)
+            self.new_function_list[byte_code_cp] = function
+
+            if len(self.stack) == 0:
+                logging.debug("Parse completed.")
+                return True
+
+        else:
+            logging.error("Parser error!")
+            self.failed = True
+            return True
+
+        return False
+
+    def reuse_function(self, debugger, byte_code_cp, func_desc):
+        # Returns the cached function at the current position if the target
+        # reported the same one and it is not live, otherwise a new function.
+        is_func = len(self.stack) != 0
+        if self.cached is None:
+            self.cached = debugger.function_cache.get(func_desc["source"])
+
+        position = self.position
+        self.position += 1
+
+        live = False
+        if position < len(self.cached):
+            function = self.cached[position]
+            live = debugger.function_list.get(function.byte_code_cp) is function
+            if not live and function.matches(is_func, func_desc["line"], func_desc["column"],
+                                             func_desc["name"], func_desc["lines"], func_desc["offsets"]):
+                logging.debug("Function {0x%x} reused for {0x%x}", function.byte_code_cp, byte_code_cp)
+                function.rebind(byte_code_cp)
+                return function
+
+        function = JerryFunction(is_func,
+                                 byte_code_cp,
+                                 func_desc["source"],
+                                 func_desc["line"],
+                                 func_desc["column"],
+                                 func_desc["name"],
+                                 func_desc["lines"],
+                                 func_desc["offsets"])
+
+        if position == len(self.cached):
+            self.cached.append(function)
+        elif not live:
+            self.cached[position] = function
+        return function
+
+
+def pending_breakpoint(location):
+    # The JerryPendingBreakpoint of a 'file:line' or function name location.
+    line = re.match("(.*):(\\d+)$", location)
+
+    if line:
+        return JerryPendingBreakpoint(int(line.group(2)), line.group(1))
+    return JerryPendingBreakpoint(function=location)
+
+
+def parse_source(debugger, data):
+    # Feeds a parse frame to the parser of the current script. Once the
+    # script is complete, its functions are registered and the pending
+    # breakpoints are set on them.
+    if debugger.parser is None:
+        debugger.parser = SourceParser()
+
+    parser = debugger.parser
+    if not parser.feed(debugger, data):
+        return
+
+    debugger.parser = None
+    if parser.failed:
+        return
+
+    new_function_list = parser.new_function_list
+
+    # Copy the ready list to the global storage.
     for function in new_function_list.values():
-        for line, breakpoint in function.lines.items():
-            debugger.line_list.insert(line, breakpoint)
+        debugger.add_function(function)
 
     # Try to set the pending breakpoints
     if debugger.pending_breakpoint_list:
@@ -1020,22 +2779,16 @@ def parse_source(debugger, data):
                       debugger.pending_breakpoint_list)
         bp_list = debugger.pending_breakpoint_list
 
-        for breakpoint_index, breakpoint in bp_list.items():
-            for src in debugger.function_list.values():
-                if src.source_name == breakpoint.source_name:
-                    source_lines = len(src.source)
-                else:
-                    source_lines = 0
-
-            if breakpoint.line:
-                if breakpoint.line <= source_lines:
-                    command = breakpoint.source_name + \
-                        ":" + str(breakpoint.line)
-                    if set_breakpoint(debugger, command, True):
-                        del bp_list[breakpoint_index]
-            elif breakpoint.function:
-                command = breakpoint.function
-                if set_breakpoint(debugger, command, True):
+        # The pending breakpoints did not match the functions parsed before,
+        # so only the new ones are searched. Breakpoints set here are written
+        # to the target at once.
+        with debugger.batch():
+            for breakpoint_index, breakpoint in list(bp_list.items()):
+                matches = find_breakpoints(debugger, breakpoint.source_name, breakpoint.line,
+                                           breakpoint.function, new_function_list)
+                for match in matches:
+                    enable_breakpoint(debugger, match)
+                if matches:
                     del bp_list[breakpoint_index]
 
         if not bp_list:
@@ -1045,6 +2798,11 @@ def parse_source(debugger, data):
         logging.debug("No pending breakpoints")
 
 
+def decode_string(data):
+    # Strings arrive from the target as UTF-8 byte sequences.
+    return bytes(data).decode("utf-8", "replace")
+
+
 def src_check_args(args):
     try:
         line_num = int(args)
@@ -1097,14 +2855,14 @@ def release_function(debugger, data):
     byte_code_cp = struct.unpack(debugger.byte_order + debugger.cp_format,
                                  data[3: 3 + debugger.cp_size])[0]
 
-    function = debugger.function_list[byte_code_cp]
-
-    for line, breakpoint in function.lines.items():
-        debugger.line_list.delete(line, breakpoint)
-        if breakpoint.active_index >= 0:
-            del debugger.active_breakpoint_list[breakpoint.active_index]
+    parser = debugger.parser
+    if parser is not None and byte_code_cp in parser.new_function_list:
+        # Redefined functions are dropped during parsing.
+        del parser.new_function_list[byte_code_cp]
+        debugger.send_bytecode_cp(byte_code_cp)
+        return
 
-    del debugger.function_list[byte_code_cp]
+    debugger.remove_function(debugger.function_list[byte_code_cp])
 
     debugger.send_bytecode_cp(byte_code_cp)
 
@@ -1117,11 +2875,11 @@ def enable_breakpoint(debugger, breakpoint):
             debugger.next_breakpoint_index += 1
             breakpoint.index = debugger.next_breakpoint_index
             debugger.pending_breakpoint_list[debugger.next_breakpoint_index] = breakpoint
-            print("%sPending breakpoint%s at %s" %
-                  (debugger.yellow, debugger.nocolor, breakpoint))
+            debugger.report("%sPending breakpoint%s at %s" %
+                            (debugger.yellow, debugger.nocolor, breakpoint))
         else:
-            print("%sPending breakpoint%s already exists" %
-                  (debugger.yellow, debugger.nocolor))
+            debugger.report("%sPending breakpoint%s already exists" %
+                            (debugger.yellow, debugger.nocolor))
 
     else:
         if breakpoint.active_index < 0:
@@ -1130,33 +2888,37 @@ def enable_breakpoint(debugger, breakpoint):
             breakpoint.active_index = debugger.next_breakpoint_index
             debugger.send_breakpoint(breakpoint)
 
-        print("%sBreakpoint %d %sat %s" % (debugger.green,
-                                           breakpoint.active_index, debugger.nocolor, breakpoint))
+        debugger.report("%sBreakpoint %d %sat %s" % (debugger.green,
+                                                     breakpoint.active_index, debugger.nocolor, breakpoint))
 
 
-def set_breakpoint(debugger, string, pending):
-    line = re.match("(.*):(\\d+)$", string)
-    found = False
-
+def find_breakpoints(debugger, source_name, line, name, functions=None):
+    # The breakpoints of a 'file:line' location, or of the first line of the
+    # functions called 'name'. The search is limited to 'functions', a byte
+    # code pointer keyed dict, when it is given.
     if line:
-        source_name = line.group(1)
-        new_line = int(line.group(2))
+        breakpoints = debugger.line_index.get((source_name, line))
+    else:
+        breakpoints = [function.lines[function.first_breakpoint_line]
+                       for function in debugger.name_index.get(name)]
+
+    if functions is None:
+        return breakpoints
+    return [breakpoint for breakpoint in breakpoints
+            if functions.get(breakpoint.function.byte_code_cp) is breakpoint.function]
 
-        for breakpoint in debugger.line_list.get(new_line):
-            func_source = breakpoint.function.source_name
-            if (source_name == func_source or
-                    func_source.endswith("/" + source_name) or
-                    func_source.endswith("\\" + source_name)):
 
-                enable_breakpoint(debugger, breakpoint)
-                found = True
+def set_breakpoint(debugger, string, pending):
+    line = re.match("(.*):(\\d+)$", string)
 
+    if line:
+        breakpoints = find_breakpoints(debugger, line.group(1), int(line.group(2)), None)
     else:
-        for function in debugger.function_list.values():
-            if function.name == string:
-                enable_breakpoint(
-                    debugger, function.lines[function.first_breakpoint_line])
-                found = True
+        breakpoints = find_breakpoints(debugger, None, None, string)
+
+    for breakpoint in breakpoints:
+        enable_breakpoint(debugger, breakpoint)
+    found = bool(breakpoints)
 
     if not found and not pending:
         print("No breakpoint found, do you want to add a %spending breakpoint%s? (y or [n])" %
@@ -1164,15 +2926,7 @@ def set_breakpoint(debugger, string, pending):
 
         ans = sys.stdin.readline()
         if ans in ['yes\n', 'y\n']:
-            if not debugger.pending_breakpoint_list:
-                debugger.send_parser_config(1)
-
-            if line:
-                breakpoint = JerryPendingBreakpoint(
-                    int(line.group(2)), line.group(1))
-            else:
-                breakpoint = JerryPendingBreakpoint(function=string)
-            enable_breakpoint(debugger, breakpoint)
+            debugger.add_pending_breakpoint(string)
 
     elif not found and pending:
         return False
@@ -1190,13 +2944,37 @@ def get_breakpoint(debugger, breakpoint_data):
     if offset < function.first_breakpoint_offset:
         return (function.offsets[function.first_breakpoint_offset], False)
 
-    nearest_offset = -1
+    # The nearest breakpoint offset before 'offset'
+    index = bisect.bisect_right(function.sorted_offsets, offset) - 1
+    return (function.offsets[function.sorted_offsets[index]], False)
 
-    for current_offset in function.offsets:
-        if current_offset <= offset and current_offset > nearest_offset:
-            nearest_offset = current_offset
 
-    return (function.offsets[nearest_offset], False)
+def stop_message(debugger, breakpoint, exact):
+    if exact:
+        breakpoint_info = "at"
+    else:
+        breakpoint_info = "around"
+
+    if breakpoint.active_index >= 0:
+        breakpoint_info += " breakpoint:%s%d%s" % (
+            debugger.red, breakpoint.active_index, debugger.nocolor)
+
+    return "Stopped %s %s" % (breakpoint_info, breakpoint)
+
+
+def output_message(debugger, subtype, message):
+    # Formats a line printed by the target, None for unknown subtypes.
+    message = message.rstrip('\n')
+    if subtype in [JERRY_DEBUGGER_OUTPUT_OK,
+                   JERRY_DEBUGGER_OUTPUT_DEBUG]:
+        return "%sout: %s%s" % (debugger.blue, debugger.nocolor, message)
+    elif subtype == JERRY_DEBUGGER_OUTPUT_WARNING:
+        return "%swarning: %s%s" % (debugger.yellow, debugger.nocolor, message)
+    elif subtype == JERRY_DEBUGGER_OUTPUT_ERROR:
+        return "%serr: %s%s" % (debugger.red, debugger.nocolor, message)
+    elif subtype == JERRY_DEBUGGER_OUTPUT_TRACE:
+        return "%strace: %s%s" % (debugger.blue, debugger.nocolor, message)
+    return None
 
 
 def input_ready_windows():
@@ -1221,28 +2999,86 @@ def input_ready_windows():
 
 
 def check_sum(data, len):
-    sum = 0
-    for i in range(len):
-        sum += ord(data[i])
     # Limit the return value to a range that can be represented by one byte
-    return sum % 256
+    return sum(memoryview(data)[0:len]) % 256
 
 
-def construct_msg(target, payload):
+def construct_msg(target, payload, header=b""):
     # 1 byte - 7E(escape)
     # 2 byte - target
     # 3-4 bytes - size (0 to 64K)
-    # beyond - payload
-    escape = chr(0x7e)
-    tar = chr(target)  # convert to byte
-    size = len(payload)
-    # calc size and convert to byte
-    size2 = chr(int(hex(size & 0xff), 0)) + chr(size >> 8)
-    if target == TARGET_FILE_DEPLOY:
-        check = chr(check_sum(payload, size))
-    else:
-        check = chr(0)
-    return escape + tar + size2 + payload + check
+    # beyond - header and payload
+    #
+    # The payload may be any bytes-like object, such as a memoryview of a
+    # deploy chunk. It is copied once, straight into the frame.
+    start = 4 + len(header)
+    size = len(header) + len(payload)
+    frame = bytearray(4 + size + 1)
+    struct.pack_into("<BBH", frame, 0, 0x7e, target, size)
+    frame[4:start] = header
+    frame[start:start + len(payload)] = payload
+
+    with memoryview(frame)[4:4 + size] as body:
+        if tracer is not None:
+            tracer.record(TRACE_OUTBOUND, target, body)
+
+        if target in CHECKSUM_TARGETS:
+            frame[-1] = check_sum(body, size)
+    return frame
+
+
+def read_reply(port, assembler, target, timeout):
+    # Waits for a reply of 'target' on a port which is not served by a
+    # SerialReader. Debugger frames and console output are dropped.
+    deadline = time.time() + timeout
+
+    while True:
+        for _ in assembler.frames():
+            pass
+
+        while assembler.replies:
+            reply_target, payload = assembler.replies.popleft()
+            if reply_target == target:
+                return payload
+
+        if time.time() >= deadline:
+            return None
+
+        assembler.feed(port.read(max(port.in_waiting, 1)))
+
+
+def negotiate_baudrate(port, get_reply, baudrate):
+    # Moves both sides of the link to 'baudrate' and returns the rate in use.
+    #
+    # The request (u32 rate) is answered at the current rate with the accepted
+    # rate, or 0 if the target refuses it. Both sides switch, then the client
+    # repeats the request at the new rate. If this confirmation is lost, the
+    # target returns to its previous rate after NEGOTIATE_TIMEOUT and so does
+    # the client, so a failed attempt leaves a working link. Targets which do
+    # not know TARGET_BAUD_RATE never answer and nothing changes.
+    current = port.baudrate
+    if baudrate == current:
+        return current
+
+    request = construct_msg(TARGET_BAUD_RATE, struct.pack("<I", baudrate))
+    confirmation = struct.pack("<I", baudrate)
+
+    port.write(request)
+    if get_reply(TARGET_BAUD_RATE, NEGOTIATE_TIMEOUT) != confirmation:
+        print("Baud rate %d is not supported by the target, staying at %d" % (baudrate, current))
+        return current
+
+    port.flush()
+    port.baudrate = baudrate
+
+    port.write(request)
+    if get_reply(TARGET_BAUD_RATE, NEGOTIATE_TIMEOUT) != confirmation:
+        port.baudrate = current
+        print("No answer at %d baud, falling back to %d" % (baudrate, current))
+        return current
+
+    logging.debug("Baud rate changed to %d", baudrate)
+    return baudrate
 
 
 def deploy_once(port, msg):
@@ -1263,33 +3099,752 @@ def deploy_packet(port, msg):
         time.sleep(0.1)
 
 
-def deploy_file(port, file, packet):
-    txt = open(file, 'r').read()
-    if len(txt) <= 0:
+def deflate_script(data):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -DEPLOY_DEFLATE_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def deploy_window(connection, data, progress=None, compress=False, file_type=DEPLOY_SCRIPT):
+    # Acknowledged deploy with several chunks in flight. Returns False if
+    # the target does not know TARGET_DEPLOY_CHUNK. 'progress' is called
+    # with the acknowledged and total chunk counts and the number of
+    # chunks sent again.
+    #
+    # BEGIN (u32 size, u16 chunk size, u32 file CRC32) is answered with the
+    # window (chunks the target can buffer, 0 if it refuses the file), the
+    # chunk size it accepts and the first chunk it is missing: a target
+    # holding part of the same file from an interrupted deploy resumes
+    # there. Every DATA (u16 sequence number, u32 chunk CRC32, data) is
+    # answered with an ACK or a NAK of its sequence number; the target
+    # acknowledges a chunk once it is stored, which paces the client.
+    # NAKed chunks are sent again at once, all chunks in flight after
+    # DEPLOY_TIMEOUT without an answer. END (file CRC32) is answered with
+    # the verification result.
+    #
+    # With 'compress' the file is sent deflated if that makes it smaller:
+    # BEGIN then describes the deflated stream and carries the encoding
+    # and the size of the inflated file. The target repeats the encoding
+    # after its resume position. Older targets do not, and targets without
+    # an inflater answer DEPLOY_RAW; the deploy then starts over uncompressed.
+    # Files other than scripts carry the same fields plus the 'file_type',
+    # which the target repeats after the encoding. Older targets would run
+    # such a file as a script, so they are refused before any data is sent.
+    #
+    # Chunks are sized to take about 50 ms on the link.
+    port = connection.port
+    chunk_size = max(MIN_DEPLOY_CHUNK, min(port.baudrate // 10 // 20, MAX_DEPLOY_CHUNK))
+    original = data
+    encoding = DEPLOY_RAW
+
+    if compress:
+        deflated = deflate_script(data)
+        if len(deflated) < len(data):
+            logging.debug("Deflated %d bytes to %d", len(data), len(deflated))
+            data, encoding = deflated, DEPLOY_DEFLATE
+
+    file_crc = zlib.crc32(data)
+    begin = bytearray(struct.pack("<BIHI", DEPLOY_BEGIN, len(data), chunk_size, file_crc))
+    if encoding != DEPLOY_RAW:
+        begin += struct.pack("<BI", encoding, len(original))
+    if file_type != DEPLOY_SCRIPT:
+        if encoding == DEPLOY_RAW:
+            begin += struct.pack("<BI", encoding, len(original))
+        begin.append(file_type)
+
+    port.write(construct_msg(TARGET_DEPLOY_CHUNK, begin))
+    reply = connection.get_reply(TARGET_DEPLOY_CHUNK, DEPLOY_TIMEOUT)
+    if reply is None or len(reply) < 6 or reply[0] != DEPLOY_BEGIN:
+        return False
+
+    if encoding != DEPLOY_RAW and (len(reply) < 7 or reply[6] != encoding):
+        logging.debug("The target cannot inflate the file, sending it uncompressed")
+        return deploy_window(connection, original, progress, False, file_type)
+
+    if file_type != DEPLOY_SCRIPT and (len(reply) < 8 or reply[7] != file_type):
+        raise Exception("The target cannot store %s files" % (file_type_name(file_type)))
+
+    window, chunk_size, next_seq = struct.unpack("<BHH", reply[1:6])
+    if window == 0 or chunk_size == 0:
+        raise Exception("Deploy refused by the target")
+    connection.sent_size = len(data)
+
+    chunk_count = (len(data) + chunk_size - 1) // chunk_size
+    if chunk_count > 0x10000:
+        raise Exception("File too large for chunks of %d bytes" % (chunk_size))
+
+    if next_seq:
+        print("%s: resuming the deploy at chunk %d of %d" % (connection.url, next_seq, chunk_count))
+
+    view = memoryview(data)
+    retries = {}
+    acked = next_seq
+    resent = 0
+
+    def send(seq):
+        chunk = view[seq * chunk_size:(seq + 1) * chunk_size]
+        header = struct.pack("<BHI", DEPLOY_DATA, seq, zlib.crc32(chunk))
+        port.write(construct_msg(TARGET_DEPLOY_CHUNK, chunk, header))
+
+    def resend(seq):
+        nonlocal resent
+        resent += 1
+        retries[seq] += 1
+        if retries[seq] > DEPLOY_RETRIES:
+            raise Exception("Chunk %d of %d not acknowledged" % (seq, chunk_count))
+        send(seq)
+
+    while next_seq < chunk_count or retries:
+        while next_seq < chunk_count and len(retries) < window:
+            send(next_seq)
+            retries[next_seq] = 0
+            next_seq += 1
+
+        reply = connection.get_reply(TARGET_DEPLOY_CHUNK, DEPLOY_TIMEOUT)
+        if reply is None:
+            logging.debug("Deploy timeout, resending %d chunks", len(retries))
+            for seq in sorted(retries):
+                resend(seq)
+            continue
+
+        if len(reply) < 3:
+            continue
+
+        op, seq = struct.unpack("<BH", reply[0:3])
+        if seq not in retries:
+            continue
+
+        if op == DEPLOY_ACK:
+            del retries[seq]
+            acked += 1
+            if progress is not None:
+                progress(acked, chunk_count, resent)
+        elif op == DEPLOY_NAK:
+            logging.debug("Chunk %d rejected, resending", seq)
+            resend(seq)
+
+    port.write(construct_msg(TARGET_DEPLOY_CHUNK, struct.pack("<BI", DEPLOY_END, file_crc)))
+    reply = connection.get_reply(TARGET_DEPLOY_CHUNK, DEPLOY_TIMEOUT)
+    if reply is None or len(reply) < 2 or reply[0] != DEPLOY_END or not reply[1]:
+        raise Exception("Deployed file not verified by the target")
+
+    return True
+
+
+def query_deploy_hash(connection):
+    # Asks the target for the SHA-256 of its deployed script (32 zero bytes
+    # if there is none) and its identity. Returns (None, None) if the target
+    # does not know TARGET_DEPLOY_HASH.
+    connection.port.write(construct_msg(TARGET_DEPLOY_HASH, b""))
+    reply = connection.get_reply(TARGET_DEPLOY_HASH, DEPLOY_TIMEOUT)
+    if reply is None or len(reply) < 32:
+        return None, None
+    return reply[0:32], decode_string(reply[32:]) or None
+
+
+def check_deployed(connection, digest, cache):
+    # Returns whether the target already runs the file with SHA-256
+    # 'digest', and the key of the target in the DeployCache. The hash
+    # reported by the target decides, the cache is only trusted for
+    # targets that cannot report one. A target that does not answer is
+    # kept as stock firmware, so the next uploads to it do not wait for
+    # the extension replies.
+    if cache.is_stock(connection.url):
+        connection.extensions = False
+
+    if connection.extensions:
+        target_digest, identity = query_deploy_hash(connection)
+
+        if target_digest is not None:
+            return target_digest == digest, identity or connection.url
+
+        connection.extensions = False
+        cache.set_stock(connection.url)
+
+    return cache.get(connection.url) == digest.hex(), connection.url
+
+
+def upload_data(connection, data, mode, progress=None, compress=False, file_type=DEPLOY_SCRIPT):
+    # 'mode' is "window" (falls back to "packet" on targets without the
+    # windowed deploy), "packet" or "once". Returns True if the target
+    # verified the data, which only the windowed deploy does. Files other
+    # than scripts need the windowed deploy.
+    if mode == "window" and connection.extensions:
+        reconnects = 0
+        while True:
+            try:
+                if deploy_window(connection, data, progress, compress, file_type):
+                    return True
+                connection.extensions = False
+                break
+            except (serial.SerialException, OSError) as val_errno:
+                reconnects += 1
+                if reconnects > DEPLOY_RECONNECTS:
+                    raise Exception("Deploy failed, connection lost %d times: %s" % (reconnects, val_errno))
+
+                # The target keeps the stored chunks, continue from there.
+                print("%s: connection lost (%s), waiting for the target..." % (connection.url, val_errno))
+                connection.reopen()
+
+    if file_type != DEPLOY_SCRIPT:
+        raise Exception("%s files need the windowed deploy, which the target does not support"
+                        % (file_type_name(file_type).capitalize()))
+
+    if len(data) > MAX_FILE_DEPLOY:
+        raise Exception("Scripts over %d bytes need the windowed deploy, which the target does not support"
+                        % (MAX_FILE_DEPLOY))
+
+    msg = construct_msg(TARGET_FILE_DEPLOY, data)
+    connection.sent_size = len(data)
+
+    if mode == "once":
+        deploy_once(connection.port, msg)
+    else:
+        deploy_packet(connection.port, msg)
+
+    return False
+
+
+def file_type_name(file_type):
+    for name, value in DEPLOY_FILE_TYPES.items():
+        if value == file_type:
+            return name
+    return "unknown"
+
+
+def read_deploy_file(file, file_type="auto"):
+    # Returns the content of 'file' and its DEPLOY_* type. With "auto"
+    # snapshots are recognized by their magic and anything holding NUL
+    # bytes is an asset. Other files are scripts in any encoding, such
+    # as GBK, and are sent as they are.
+    with open(file, 'rb') as input_file:
+        data = input_file.read()
+
+    if len(data) <= 0:
         raise Exception("File '{}' is empty".format(file))
-    msg = construct_msg(TARGET_FILE_DEPLOY, txt)
-    print("Upload JS with content".center(50, "-"))
-    if packet == True:
-        deploy_packet(port, msg)
+
+    if file_type != "auto":
+        return data, DEPLOY_FILE_TYPES[file_type]
+
+    if data.startswith(SNAPSHOT_MAGIC):
+        return data, DEPLOY_SNAPSHOT
+
+    return data, DEPLOY_ASSET if b"\0" in data else DEPLOY_SCRIPT
+
+
+def read_script(file):
+    # Returns the bytes of a script, the encoding is left to the target.
+    data, file_type = read_deploy_file(file)
+
+    if file_type != DEPLOY_SCRIPT:
+        raise Exception("File '%s' is not a script" % (file))
+
+    return data
+
+
+def deploy_file(connection, file, mode, cache=None, compress=False, file_type="auto"):
+    # Uploads 'file' through 'connection', see upload_data(). With a
+    # DeployCache the upload is skipped if the target already runs the
+    # file. Returns False if the upload was skipped.
+    data, file_type = read_deploy_file(file, file_type)
+    digest = hashlib.sha256(data).digest()
+
+    if cache is not None:
+        deployed, key = check_deployed(connection, digest, cache)
+
+        if deployed:
+            print("%s already runs '%s', upload skipped" % (key, file))
+            return False
+
+    # Only the sizes are printed, echoing a large script costs more than
+    # sending it.
+    print(("Upload %s, %d bytes" % (file_type_name(file_type), len(data))).center(50, "-"))
+    verified = upload_data(connection, data, mode, compress=compress, file_type=file_type)
+    if connection.sent_size < len(data):
+        print("Sent %d bytes deflated" % (connection.sent_size))
+    print(("Finished writing %s to COM port" % (file_type_name(file_type))).center(50, "-"))
+
+    if verified:
+        if cache is not None:
+            cache.put(key, digest.hex())
     else:
-        deploy_once(port, msg)
-    print(txt)
-    print("Finished writing source code to COM port".center(50, "-"))
-    print(port.readline())
+        print(connection.port.readline())
+
+    return True
+
+
+def upload_unless_deployed(connection, data, mode, cache=None, compress=False):
+    # Uploads a script unless the target already runs it, see
+    # check_deployed(). Returns False if the upload was skipped.
+    digest = hashlib.sha256(data).digest()
+
+    if cache is not None:
+        deployed, key = check_deployed(connection, digest, cache)
+
+        if deployed:
+            return False
+
+    if upload_data(connection, data, mode, compress=compress) and cache is not None:
+        cache.put(key, digest.hex())
+
+    return True
+
+
+def tail_output(debugger, duration=None, first_output=None):
+    # Streams the output of the running script, both the output messages
+    # and the console output of the target, for 'duration' seconds (until
+    # interrupted if None). Nothing stops: the engine is resumed at every
+    # breakpoint, exceptions are reported. 'first_output' is called once,
+    # before the first output is printed.
+    deadline = time.time() + duration if duration is not None else float("inf")
+
+    def show(text):
+        nonlocal first_output
+        if first_output is not None:
+            first_output()
+            first_output = None
+        sys.stdout.write(text)
+        sys.stdout.flush()
+
+    while time.time() < deadline:
+        while debugger.reader is not None and not debugger.reader.console.empty():
+            show(decode_string(debugger.reader.console.get()))
+
+        data = debugger.get_message(False, min(POLL_INTERVAL, max(deadline - time.time(), 0)))
+
+        if data == b'':
+            continue
+
+        if data is None:
+            if debugger.reconnect():
+                continue
+            break
+
+        event = debugger.handle_message(data)
+        if event is None:
+            continue
+
+        buffer_type, result = event
+        if buffer_type in [JERRY_DEBUGGER_BREAKPOINT_HIT, JERRY_DEBUGGER_EXCEPTION_HIT]:
+            breakpoint, exact, exception_string = result
+            if exception_string is not None:
+                show("%sexception: %s%s at %s\n" % (debugger.red, debugger.nocolor,
+                                                    exception_string, breakpoint))
+            debugger.send_command(JERRY_DEBUGGER_CONTINUE)
+
+        elif buffer_type == JERRY_DEBUGGER_OUTPUT_RESULT_END:
+            text = output_message(debugger, result[0], result[1])
+            if text is not None:
+                show(text + "\n")
+
+
+def bundle_scripts(files):
+    # The target runs a single script, the scripts are joined in the given
+    # order and each one is headed by its file name.
+    parts = []
+
+    for file in files:
+        parts.append(b"// %s\n%s\n" % (os.path.basename(file).encode("utf-8"), read_script(file)))
+
+    return b"".join(parts)
+
+
+def deploy_bundle(connection, data, config, mode, cache=None, compress=False):
+    # Provisions the target in one session: the engine is stopped, the
+    # joined scripts and the optional config blob are sent and the script
+    # is started. Nothing waits for the target except the acknowledgements
+    # of the windowed deploy, the frames are processed in order. Returns
+    # the seconds spent in each phase.
+    timings = collections.OrderedDict()
+    start = time.time()
+
+    connection.port.write(construct_msg(TARGET_STOP_ENGINE, b""))
+    timings["stop"] = time.time() - start
+
+    if not upload_unless_deployed(connection, data, mode, cache, compress):
+        print("%s already runs the scripts, upload skipped" % (connection.url))
+    timings["scripts"] = time.time() - start - sum(timings.values())
+
+    if config is not None:
+        connection.port.write(construct_msg(TARGET_CONFIG_DEPLOY, config))
+        timings["config"] = time.time() - start - sum(timings.values())
+
+    connection.port.write(construct_msg(TARGET_FILE_EXECUTE, b""))
+    connection.port.flush()
+    timings["execute"] = time.time() - start - sum(timings.values())
+
+    return timings
+
+
+class DeployProgress(object):
+    # Progress lines of a parallel deploy, one line per board for every
+    # tenth of the file that is acknowledged.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.steps = {}
+        self.resent = {}
+
+    def report(self, url, text):
+        with self.lock:
+            print("%s: %s" % (url, text))
+
+    def update(self, url, acked, total, resent):
+        self.resent[url] = resent
+        step = acked * 10 // total
+
+        if self.steps.get(url, 0) == step:
+            return
+
+        self.steps[url] = step
+        self.report(url, "%3d%% (%d/%d chunks, %d resent)" % (acked * 100 // total, acked, total, resent))
+
+
+def expand_ports(patterns):
+    # Globs are matched against the existing device files, anything else
+    # (socket:// URLs, COM ports) is used as it is.
+    ports = []
+
+    for pattern in patterns:
+        if "://" not in pattern and glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern))
+            if not matches:
+                raise Exception("No port matches '%s'" % (pattern))
+            ports.extend(matches)
+        elif pattern not in ports:
+            ports.append(pattern)
+
+    return ports
+
+
+def deploy_board(url, data, file_type, digest, args, cache, progress):
+    # Deploys to one board of a parallel deploy. Returns "uploaded",
+    # "verified" or "skipped", exceptions are reported by the caller.
+    connection = UploadConnection(url, args.baud)
+    connection.open()
+
+    try:
+        if args.negotiate_baud:
+            negotiate_baudrate(connection.port, connection.get_reply, args.negotiate_baud)
+
+        if cache is not None:
+            deployed, key = check_deployed(connection, digest, cache)
+
+            if deployed:
+                return "skipped"
+
+        progress.report(url, "uploading %d bytes at %d baud" % (len(data), connection.port.baudrate))
+
+        def update(acked, total, resent):
+            progress.update(url, acked, total, resent)
+
+        if not upload_data(connection, data, args.deploy_mode, update, args.deploy_compression == "deflate",
+                           file_type):
+            return "uploaded"
+
+        if cache is not None:
+            cache.put(key, digest.hex())
+
+        return "verified"
+    finally:
+        connection.close()
+
+
+def deploy_main(args):
+    data, file_type = read_deploy_file(args.file, args.file_type)
+    digest = hashlib.sha256(data).digest()
+    ports = expand_ports(args.ports)
+    cache = None if args.force_upload else DeployCache(args.deploy_cache)
+    progress = DeployProgress()
+    results = {}
+
+    print(("Deploy %s %s to %d boards" % (file_type_name(file_type), os.path.basename(args.file), len(ports)))
+          .center(50, "-"))
+    start = time.time()
+
+    # The boards are paced by their links, a thread per board is enough.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs or len(ports)) as executor:
+        futures = {}
+
+        for url in ports:
+            futures[executor.submit(deploy_board, url, data, file_type, digest, args, cache, progress)] = url
+
+        for future in concurrent.futures.as_completed(futures):
+            url = futures[future]
+
+            try:
+                results[url] = (future.result(), time.time() - start)
+            except Exception as val_errno:
+                results[url] = ("failed: %s" % (val_errno), time.time() - start)
+
+            progress.report(url, results[url][0])
+
+    elapsed = time.time() - start
+    sent = 0
+
+    print("Deploy summary".center(50, "-"))
+
+    for url in ports:
+        status, finished = results[url]
+
+        if status in ("uploaded", "verified"):
+            sent += len(data)
+            status += " in %.1f s, %d chunks resent" % (finished, progress.resent.get(url, 0))
+
+        print("%s: %s" % (url, status))
+
+    failed = sum(1 for status, _ in results.values() if status.startswith("failed"))
+    print("%d boards, %d failed, %d bytes sent in %.1f s (%.1f KB/s in total)"
+          % (len(ports), failed, sent, elapsed, sent / 1024 / max(elapsed, 0.001)))
+
+
+def bundle_main(args):
+    data = bundle_scripts(args.scripts)
+    config = None
+
+    if args.config is not None:
+        with open(args.config, "rb") as config_file:
+            config = config_file.read()
+
+        if len(config) > 0xffff:
+            raise Exception("Config '%s' is larger than 64K" % (args.config))
+
+    cache = None if args.force_upload else DeployCache(args.deploy_cache)
+    connection = UploadConnection(args.port, args.baud)
+    connection.open()
+
+    try:
+        if args.negotiate_baud:
+            negotiate_baudrate(connection.port, connection.get_reply, args.negotiate_baud)
+
+        print(("Bundle of %d scripts, %d bytes" % (len(args.scripts), len(data))).center(50, "-"))
+        timings = deploy_bundle(connection, data, config, args.deploy_mode, cache,
+                                args.deploy_compression == "deflate")
+        print("Bundle deployed in %.2f s (%s)"
+              % (sum(timings.values()), ", ".join("%s %.2f s" % item for item in timings.items())))
+        print(connection.port.readline())
+    finally:
+        connection.close()
+
+
+def run_main(args):
+    # Upload, execute and output on one open port. The phases are timed
+    # from the start of the command: opening the port (and negotiating the
+    # baud rate), the upload, the execution until the engine announced the
+    # debugger, and the wait for the first output.
+    timings = collections.OrderedDict()
+    start = time.time()
+
+    def phase(name):
+        timings[name] = time.time() - start - sum(timings.values())
+
+    def report():
+        phase("first output")
+        print("-" * 50)
+        print("%.2f s to the first output (%s)"
+              % (sum(timings.values()), ", ".join("%s %.2f s" % item for item in timings.items())))
+        print("-" * 50)
+
+    data = read_script(args.script)
+    cache = None if args.force_upload else DeployCache(args.deploy_cache)
+    connection = UploadConnection(args.port, args.baud)
+    connection.open()
+    debugger = None
+
+    try:
+        if args.negotiate_baud:
+            negotiate_baudrate(connection.port, connection.get_reply, args.negotiate_baud)
+        phase("open")
+
+        if not upload_unless_deployed(connection, data, args.deploy_mode, cache,
+                                      args.deploy_compression == "deflate"):
+            print("%s already runs '%s', upload skipped" % (args.port, args.script))
+        phase("upload")
+
+        connection.port.write(construct_msg(TARGET_FILE_EXECUTE, b""))
+        debugger = JerrySerialDebugger(args.port, args.baud, args.negotiate_baud, connection, console=True)
+        phase("execute")
+        sys.stdout.write(decode_string(debugger.boot_log))
+
+        if args.color:
+            debugger.set_colors()
+
+        tail_output(debugger, args.tail, report)
+
+        if "first output" not in timings:
+            print("No output (%s)" % (", ".join("%s %.2f s" % item for item in timings.items())))
+    finally:
+        if debugger is not None:
+            debugger.close()
+        connection.close()
+
+
+def dump_trace(path):
+    inbound_names = ("CONFIGURATION PARSE_ERROR BYTE_CODE_CP PARSE_FUNCTION BREAKPOINT_LIST "
+                     "BREAKPOINT_OFFSET_LIST SOURCE_CODE SOURCE_CODE_END SOURCE_CODE_NAME "
+                     "SOURCE_CODE_NAME_END FUNCTION_NAME FUNCTION_NAME_END WAITING_AFTER_PARSE "
+                     "RELEASE_BYTE_CODE_CP MEMSTATS_RECEIVE BREAKPOINT_HIT EXCEPTION_HIT "
+                     "EXCEPTION_STR EXCEPTION_STR_END BACKTRACE BACKTRACE_END EVAL_RESULT "
+                     "EVAL_RESULT_END WAIT_FOR_SOURCE OUTPUT_RESULT OUTPUT_RESULT_END").split()
+    outbound_names = ("FREE_BYTE_CODE_CP UPDATE_BREAKPOINT EXCEPTION_CONFIG PARSER_CONFIG MEMSTATS "
+                      "STOP PARSER_RESUME CLIENT_SOURCE CLIENT_SOURCE_PART NO_MORE_SOURCES "
+                      "CONTEXT_RESET CONTINUE STEP NEXT FINISH GET_BACKTRACE EVAL EVAL_PART").split()
+    target_names = dict((value, name[len("TARGET_"):]) for name, value in globals().items()
+                        if name.startswith("TARGET_"))
+
+    record_header = ProtocolTracer.record_header
+
+    with open(path, "rb") as trace_file:
+        if trace_file.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+            raise Exception("'%s' is not a trace capture" % (path))
+
+        while True:
+            header = trace_file.read(record_header.size)
+            if len(header) < record_header.size:
+                break
+
+            timestamp, direction, target, size = record_header.unpack(header)
+            frame = trace_file.read(size)
+
+            if target == TARGET_DEBUGGER and len(frame) >= 3:
+                if direction == TRACE_INBOUND:
+                    # 82, size, type
+                    names, message_type = inbound_names, frame[2]
+                else:
+                    # 82, size, 4 byte mask, type
+                    names, message_type = outbound_names, frame[6]
+                if 1 <= message_type <= len(names):
+                    name = names[message_type - 1]
+                else:
+                    name = "UNKNOWN(%d)" % (message_type)
+            else:
+                name = target_names.get(target, "TARGET(%d)" % (target))
+
+            print("%10.6f %s %-22s %s" % (timestamp, "<-" if direction == TRACE_INBOUND else "->",
+                                          name, " ".join("%02x" % (n) for n in frame)))
+
+
+async def serve_bridge(uart, baudrate, tcp_port):
+    # Relays the raw byte stream of a board to one TCP client at a time, so
+    # remote clients can use it as --uart socket://host:port.
+    transport = AsyncSerialTransport(uart, baudrate)
+    await transport.open()
+    clients = []
+
+    async def serve(reader, writer):
+        peer = writer.get_extra_info("peername")
+        if clients:
+            logging.debug("Bridge busy, %s refused", peer)
+            writer.close()
+            return
+
+        print("Client %s connected" % (peer,))
+        clients.append(writer)
+        try:
+            while True:
+                data = await reader.read(4096)
+                if not data:
+                    break
+                transport.write(data)
+                await transport.drain()
+        except ConnectionError:
+            pass
+        finally:
+            clients.remove(writer)
+            writer.close()
+            print("Client %s disconnected" % (peer,))
+
+    server = await asyncio.start_server(serve, port=tcp_port)
+    print("Bridging %s to TCP port %d" % (uart, tcp_port))
+
+    async with server:
+        while True:
+            data = await transport.read()
+            if not data:
+                break
+
+            # Without a client the output of the board is dropped.
+            for writer in clients:
+                writer.write(data)
+
+    transport.close()
+    raise Exception("Serial port %s closed" % (uart))
+
+
+def fleet_main(args):
+    manager = SessionManager(args.uart, args.baud)
+    print(">>>Reboot your boards first!<<<\nWaiting for UART connections...")
+
+    try:
+        manager.start(args.color)
+
+        prompt = FleetPrompt(manager)
+        prompt.prompt = "(maplejs-fleet) "
+
+        if args.session is not None:
+            prompt.session = SessionFile(args.session)
+            state = prompt.session.load()
+
+            if state is not None:
+                async def restore(debugger):
+                    debugger.restore_session(state)
+                    await debugger.transport.drain()
+
+                prompt._report(manager.fanout(restore))
+
+        if args.exception is not None:
+            prompt.do_exception(str(args.exception))
+
+        prompt.cmdloop()
+    finally:
+        manager.close()
 
 
 def main():
+    global tracer
+
     args = arguments_parse()
 
+    if args.dump_trace is not None:
+        dump_trace(args.dump_trace)
+        return
+
+    # The deploy, bundle and run commands are traced as well.
+    if args.trace is not None:
+        tracer = ProtocolTracer(args.trace, args.trace_ring)
+
+    if args.command == "deploy":
+        deploy_main(args)
+        return
+
+    if args.command == "bundle":
+        bundle_main(args)
+        return
+
+    if args.command == "run":
+        run_main(args)
+        return
+
     if args.upload is not None and args.uart is not None:
-        ser = serial.Serial(args.uart, 115200, timeout=1)
+        if len(args.uart) > 1:
+            raise Exception("Upload expects a single UART port")
+
+        connection = UploadConnection(args.uart[0], args.baud)
+        connection.open()
 
-        # Deploy files to the device through the uart and format the printed file contents as follows
-        # --------------Upload JS with content--------------
-        # print("Hello, world!");
-        # -----Finished writing source code to COM port-----
-        deploy_file(ser, args.upload, True)
-        print(ser.readline())
+        if args.negotiate_baud:
+            negotiate_baudrate(connection.port, connection.get_reply, args.negotiate_baud)
+
+        # Deploy files to the device through the uart, the output looks as follows
+        # -------------Upload script, 22 bytes--------------
+        # -------Finished writing script to COM port--------
+        cache = None
+        if not args.force_upload:
+            cache = DeployCache(args.deploy_cache)
+
+        # deploy_file() reads the status line of an unverified upload, the
+        # windowed deploy prints none.
+        deploy_file(connection, args.upload, args.deploy_mode, cache, args.deploy_compression == "deflate",
+                    args.file_type)
 
         # Execute file through COM port
         # time.sleep(1)
@@ -1299,14 +3854,22 @@ def main():
 
         return
 
+    if args.bridge is not None and args.uart is not None:
+        asyncio.run(serve_bridge(args.uart[0], args.baud, args.bridge))
+        return
+
+    # The synchronous client reads through pyserial, WebSocket targets are
+    # served by the asyncio sessions.
+    if args.uart is not None and (len(args.uart) > 1 or args.uart[0].startswith("ws://")):
+        fleet_main(args)
+        return
+
     if args.uart is not None:
-        debugger = JerrySerialDebugger(args.uart)
+        debugger = JerrySerialDebugger(args.uart[0], args.baud, args.negotiate_baud)
         logging.debug("Connected to JerryScript on %s port", debugger.com_port)
     else:
         raise Exception("UART port expected")
 
-    exception_string = ""
-
     if args.color:
         debugger.set_colors()
 
@@ -1314,6 +3877,13 @@ def main():
     prompt.prompt = "(maplejs-debugger) "
     prompt.non_interactive = args.non_interactive
 
+    # The options below override the saved session.
+    if args.session is not None:
+        prompt.session = SessionFile(args.session)
+        state = prompt.session.load()
+        if state is not None:
+            debugger.restore_session(state)
+
     if args.display:
         prompt.do_display(args.display)
 
@@ -1337,62 +3907,38 @@ def main():
         if prompt.quit:
             break
 
-        data = debugger.get_message(False)
+        data = debugger.get_message(False, POLL_INTERVAL)
 
         if data == b'':
             continue
 
-        if not data:  # Break the while loop if there is no more data.
+        if data is None:  # The port is gone, wait for the target to come back.
+            if debugger.reconnect():
+                prompt.cont = True
+                continue
             break
 
-        buffer_type = ord(data[2])
-        buffer_size = ord(data[1]) - 1
+        logging.debug("Main buffer type: %d, message size: %d", data[2], data[1] - 1)
 
-        logging.debug("Main buffer type: %d, message size: %d",
-                      buffer_type, buffer_size)
+        event = debugger.handle_message(data)
+        if event is None:
+            continue
 
-        if buffer_type in [JERRY_DEBUGGER_PARSE_ERROR,
-                           JERRY_DEBUGGER_BYTE_CODE_CP,
-                           JERRY_DEBUGGER_PARSE_FUNCTION,
-                           JERRY_DEBUGGER_BREAKPOINT_LIST,
-                           JERRY_DEBUGGER_SOURCE_CODE,
-                           JERRY_DEBUGGER_SOURCE_CODE_END,
-                           JERRY_DEBUGGER_SOURCE_CODE_NAME,
-                           JERRY_DEBUGGER_SOURCE_CODE_NAME_END,
-                           JERRY_DEBUGGER_FUNCTION_NAME,
-                           JERRY_DEBUGGER_FUNCTION_NAME_END]:
-            parse_source(debugger, data)
+        buffer_type, result = event
 
-        elif buffer_type == JERRY_DEBUGGER_WAITING_AFTER_PARSE:
-            debugger.send_command(JERRY_DEBUGGER_PARSER_RESUME)
-
-        elif buffer_type == JERRY_DEBUGGER_RELEASE_BYTE_CODE_CP:
-            release_function(debugger, data)
+        if buffer_type == JERRY_DEBUGGER_CONFIGURATION:
+            prompt.cont = True
 
         elif buffer_type in [JERRY_DEBUGGER_BREAKPOINT_HIT, JERRY_DEBUGGER_EXCEPTION_HIT]:
-            breakpoint_data = struct.unpack(
-                debugger.byte_order + debugger.cp_format + debugger.idx_format, data[3:])
-
-            breakpoint = get_breakpoint(debugger, breakpoint_data)
-            debugger.last_breakpoint_hit = breakpoint[0]
+            breakpoint, exact, exception_string = result
 
             if buffer_type == JERRY_DEBUGGER_EXCEPTION_HIT:
                 print(
                     "Exception throw detected (to disable automatic stop type exception 0)")
                 if exception_string:
                     print("Exception hint: %s" % (exception_string))
-                    exception_string = ""
-
-            if breakpoint[1]:
-                breakpoint_info = "at"
-            else:
-                breakpoint_info = "around"
-
-            if breakpoint[0].active_index >= 0:
-                breakpoint_info += " breakpoint:%s%d%s" % (
-                    debugger.red, breakpoint[0].active_index, debugger.nocolor)
 
-            print("Stopped %s %s" % (breakpoint_info, breakpoint[0]))
+            print(stop_message(debugger, breakpoint, exact))
             if debugger.display:
                 print_source(prompt.debugger, debugger.display, 0)
 
@@ -1405,108 +3951,38 @@ def main():
             if prompt.quit:
                 break
 
-        elif buffer_type == JERRY_DEBUGGER_EXCEPTION_STR:
-            exception_string += data[3:]
-
-        elif buffer_type == JERRY_DEBUGGER_EXCEPTION_STR_END:
-            exception_string += data[3:]
-
-        elif buffer_type in [JERRY_DEBUGGER_BACKTRACE, JERRY_DEBUGGER_BACKTRACE_END]:
-            frame_index = 0
-
-            while True:
-
-                buffer_pos = 3
-                while buffer_size > 0:
-                    breakpoint_data = struct.unpack(debugger.byte_order + debugger.cp_format + debugger.idx_format,
-                                                    data[buffer_pos: buffer_pos + debugger.cp_size + 4])
-
-                    breakpoint = get_breakpoint(debugger, breakpoint_data)
-
-                    print("Frame %d: %s" % (frame_index, breakpoint[0]))
-
-                    frame_index += 1
-                    buffer_pos += 6
-                    buffer_size -= 6
-
-                if buffer_type == JERRY_DEBUGGER_BACKTRACE_END:
-                    break
-
-                data = debugger.get_message(True)
-                buffer_type = ord(data[2])
-                buffer_size = ord(data[1]) - 1
-
-                if buffer_type not in [JERRY_DEBUGGER_BACKTRACE,
-                                       JERRY_DEBUGGER_BACKTRACE_END]:
-                    raise Exception("Backtrace data expected")
+        elif buffer_type == JERRY_DEBUGGER_BACKTRACE_END:
+            for frame_index, breakpoint in enumerate(result):
+                print("Frame %d: %s" % (frame_index, breakpoint))
 
             prompt.cmdloop()
 
-        elif buffer_type in [JERRY_DEBUGGER_EVAL_RESULT,
-                             JERRY_DEBUGGER_EVAL_RESULT_END,
-                             JERRY_DEBUGGER_OUTPUT_RESULT,
-                             JERRY_DEBUGGER_OUTPUT_RESULT_END]:
-            message = b""
-            while True:
-                if buffer_type in [JERRY_DEBUGGER_EVAL_RESULT_END,
-                                   JERRY_DEBUGGER_OUTPUT_RESULT_END]:
-                    subtype = ord(data[-1])
-                    message += data[3:-1]
-                    break
-                else:
-                    message += data[3:]
-
-                data = debugger.get_message(True)
-                buffer_type = ord(data[2])
-                buffer_size = ord(data[1]) - 1
-                # Checks if the next frame would be an invalid data frame.
-                # If it is not the message type, or the end type of it, an exception is thrown.
-                if buffer_type not in [buffer_type, buffer_type + 1]:
-                    raise Exception("Invalid data caught")
-
+        elif buffer_type == JERRY_DEBUGGER_OUTPUT_RESULT_END:
             # Subtypes of output
-            if buffer_type == JERRY_DEBUGGER_OUTPUT_RESULT_END:
-                message = message.rstrip('\n')
-                if subtype in [JERRY_DEBUGGER_OUTPUT_OK,
-                               JERRY_DEBUGGER_OUTPUT_DEBUG]:
-                    print("%sout: %s%s" %
-                          (debugger.blue, debugger.nocolor, message))
-                elif subtype == JERRY_DEBUGGER_OUTPUT_WARNING:
-                    print("%swarning: %s%s" %
-                          (debugger.yellow, debugger.nocolor, message))
-                elif subtype == JERRY_DEBUGGER_OUTPUT_ERROR:
-                    print("%serr: %s%s" %
-                          (debugger.red, debugger.nocolor, message))
-                elif subtype == JERRY_DEBUGGER_OUTPUT_TRACE:
-                    print("%strace: %s%s" %
-                          (debugger.blue, debugger.nocolor, message))
+            message = output_message(debugger, result[0], result[1])
+            if message is not None:
+                print(message)
 
+        elif buffer_type == JERRY_DEBUGGER_EVAL_RESULT_END:
             # Subtypes of eval
-            elif buffer_type == JERRY_DEBUGGER_EVAL_RESULT_END:
-                if subtype == JERRY_DEBUGGER_EVAL_ERROR:
-                    print("Uncaught exception: %s" % (message))
-                else:
-                    print(message)
+            if result[0] == JERRY_DEBUGGER_EVAL_ERROR:
+                print("Uncaught exception: %s" % (result[1]))
+            else:
+                print(result[1])
 
-                prompt.cmdloop()
+            prompt.cmdloop()
 
         elif buffer_type == JERRY_DEBUGGER_MEMSTATS_RECEIVE:
             print("JERRY_DEBUGGER_MEMSTATS_RECEIVE")
 
-            memory_stats = struct.unpack(debugger.byte_order + debugger.idx_format * 5,
-                                         data[3: 3 + 4 * 5])
-
-            print("Allocated bytes: %d" % (memory_stats[0]))
-            print("Byte code bytes: %d" % (memory_stats[1]))
-            print("String bytes: %d" % (memory_stats[2]))
-            print("Object bytes: %d" % (memory_stats[3]))
-            print("Property bytes: %d" % (memory_stats[4]))
+            print("Allocated bytes: %d" % (result["allocated"]))
+            print("Byte code bytes: %d" % (result["byte_code"]))
+            print("String bytes: %d" % (result["string"]))
+            print("Object bytes: %d" % (result["object"]))
+            print("Property bytes: %d" % (result["property"]))
 
             prompt.cmdloop()
 
-        else:
-            raise Exception("Unknown message")
-
 
 if __name__ == "__main__":
     try:
@@ -1516,4 +3992,7 @@ if __name__ == "__main__":
     except Exception as e:
         print("Error:", e)
     finally:
+        if tracer is not None:
+            tracer.close()
         quit()
+
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+# Copyright Huawei Technologies Co. Ltd. and other contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import argparse
+import glob
+import importlib.util
+import os
+import time
+import zlib
+
+
+def load_client():
+    """Load maple-client-serial.py, which implements the deploy.
+
+    Returns:
+        The client module.
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'maple-client-serial.py')
+    spec = importlib.util.spec_from_file_location('maple_client_serial', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+client = load_client()
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_SCRIPTS = [os.path.join(ROOT, 'firmware', 'js脚本例程', '*.js'), os.path.join(ROOT, 'js-demo', '*.js')]
+
+
+def parse_argument():
+    """Parsing command line arguments.
+
+    Returns:
+        The ArgumentParser namespace with the values of the various parameters.
+    """
+    parser = argparse.ArgumentParser(
+        description='Deploy benchmark, compares the raw and the deflated windowed deploy of the '
+                    'example scripts: compression ratio, time on the link and, with --uart, the '
+                    'measured end-to-end deploy time.')
+    parser.add_argument('scripts', metavar='script', nargs='*', default=DEFAULT_SCRIPTS,
+                        help='Scripts or globs to deploy, the example scripts of the repository by default')
+    parser.add_argument('--baud', dest='baud', type=int, action='store', default=client.DEFAULT_BAUDRATE,
+                        help='Baud rate of the link (default: %(default)s)')
+    parser.add_argument('--uart', dest='uart', metavar='port', action='store', default=None,
+                        help='Deploy every script raw and deflated to this port and time it, for example '
+                             'socket://localhost:5000 of maple-device-simulator.py --tcp 5000 '
+                             '--link-rate 115200')
+    return parser.parse_args()
+
+
+def wire_size(size: int, chunk_size: int, compressed: bool):
+    """Count the bytes a windowed deploy puts on the link, see deploy_window() of the client.
+
+    Args:
+        size: Size of the transferred file.
+        chunk_size: Size of the DATA chunks.
+        compressed: Whether BEGIN carries the encoding fields.
+
+    Returns:
+        The byte count of the BEGIN, DATA and END frames.
+    """
+    frame = 5  # 0x7E, target, u16 size, checksum
+    chunks = (size + chunk_size - 1) // chunk_size
+    begin = frame + 11 + (5 if compressed else 0)
+    data = chunks * (frame + 7) + size
+    end = frame + 5
+    return begin + data + end
+
+
+def measure(url: str, baud: int, data: bytes, compress: bool):
+    """Deploy 'data' with the windowed deploy and time it.
+
+    Returns:
+        The seconds from opening the port until the target verified the file.
+    """
+    start = time.monotonic()
+    connection = client.UploadConnection(url, baud)
+    connection.open()
+    try:
+        if not client.upload_data(connection, data, 'window', compress=compress):
+            raise Exception('%s does not support the windowed deploy' % url)
+        # Not the close, pyserial waits 0.3 s when it closes a socket:// port.
+        return time.monotonic() - start
+    finally:
+        connection.close()
+
+
+def main():
+    args = parse_argument()
+    paths = []
+    for pattern in args.scripts:
+        paths.extend(sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern])
+
+    chunk_size = max(client.MIN_DEPLOY_CHUNK, min(args.baud // 10 // 20, client.MAX_DEPLOY_CHUNK))
+    header = '%-24s %7s %7s %6s %8s %9s' % ('script', 'bytes', 'deflate', 'ratio', 'raw s', 'deflate s')
+    if args.uart is not None:
+        header += ' %10s %10s' % ('raw e2e s', 'defl e2e s')
+    print('Windowed deploy at %d baud, %d byte chunks, deflate window %d bytes'
+          % (args.baud, chunk_size, 1 << client.DEPLOY_DEFLATE_WBITS))
+    print(header)
+
+    totals = [0, 0, 0.0, 0.0, 0.0, 0.0]
+    for path in paths:
+        with open(path, 'rb') as f:
+            data = f.read()
+        if not data:
+            continue
+        deflated = client.deflate_script(data)
+        assert zlib.decompress(deflated, -client.DEPLOY_DEFLATE_WBITS) == data
+        # The client sends the file raw if deflating does not shrink it.
+        compressed = len(deflated) < len(data)
+        sent = deflated if compressed else data
+        raw_time = wire_size(len(data), chunk_size, False) * 10 / args.baud
+        deflate_time = wire_size(len(sent), chunk_size, compressed) * 10 / args.baud
+        row = [len(data), len(sent), raw_time, deflate_time]
+        line = '%-24s %7d %7d %5.1f%% %8.3f %9.3f' % (os.path.basename(path)[:24], len(data), len(sent),
+                                                     len(sent) * 100 / len(data), raw_time, deflate_time)
+        if args.uart is not None:
+            row += [measure(args.uart, args.baud, data, False), measure(args.uart, args.baud, data, True)]
+            line += ' %10.3f %10.3f' % (row[4], row[5])
+        for i, value in enumerate(row):
+            totals[i] += value
+        print(line)
+
+    if totals[0]:
+        line = '%-24s %7d %7d %5.1f%% %8.3f %9.3f' % ('total', totals[0], totals[1], totals[1] * 100 / totals[0],
+                                                     totals[2], totals[3])
+        if args.uart is not None:
+            line += ' %10.3f %10.3f' % (totals[4], totals[5])
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
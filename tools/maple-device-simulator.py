@@ -0,0 +1,753 @@
+#!/usr/bin/env python
+
+# Copyright Huawei Technologies Co. Ltd. and other contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import argparse
+import collections
+import hashlib
+import importlib.util
+import os
+import pty
+import random
+import re
+import select
+import socket
+import struct
+import time
+import tty
+import zlib
+
+
+def load_client():
+    """Load maple-client-serial.py, which defines the protocol constants and framing.
+
+    Returns:
+        The client module.
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'maple-client-serial.py')
+    spec = importlib.util.spec_from_file_location('maple_client_serial', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+client = load_client()
+
+TARGETS = set(value for name, value in vars(client).items() if name.startswith('TARGET_'))
+
+
+def parse_argument():
+    """Parsing command line arguments.
+
+    Returns:
+        The ArgumentParser namespace with the values of the various parameters.
+    """
+    parser = argparse.ArgumentParser(
+        description='MapleJS device simulator, serves the UART protocol of a board running '
+                    'the debug engine on a pty or a TCP port (use --uart socket://host:port).')
+    parser.add_argument('--tcp', dest='tcp', metavar='port', type=int, action='store', default=None,
+                        help='Listen on a TCP port instead of creating a pty')
+    parser.add_argument('--source', dest='source', metavar='filename', action='store', default=None,
+                        help='Script reported by the engine, every non-empty line is a statement')
+    parser.add_argument('--name', dest='name', metavar='name', action='store', default='main.js',
+                        help='Source name of the script')
+    parser.add_argument('--functions', dest='functions', type=int, action='store', default=4,
+                        help='Functions of the generated script')
+    parser.add_argument('--lines', dest='lines', type=int, action='store', default=8,
+                        help='Statements in every function of the generated script')
+    parser.add_argument('--message-size', dest='message_size', type=int, action='store', default=125,
+                        help='Maximum debugger message size announced in the configuration')
+    parser.add_argument('--step-rate', dest='step_rate', type=float, action='store', default=100,
+                        help='Statements executed per second')
+    parser.add_argument('--output-rate', dest='output_rate', type=float, action='store', default=1,
+                        help='Output messages printed per second while running, 0 for none')
+    parser.add_argument('--output-size', dest='output_size', type=int, action='store', default=32,
+                        help='Size of an output message in bytes')
+    parser.add_argument('--parse-rate', dest='parse_rate', type=float, action='store', default=0,
+                        help='Times per second the script is released and parsed again while running')
+    parser.add_argument('--backtrace-depth', dest='backtrace_depth', type=int, action='store', default=2,
+                        help='Frames of a backtrace')
+    parser.add_argument('--max-baud', dest='max_baud', type=int, action='store', default=921600,
+                        help='Highest baud rate accepted by the baud rate negotiation')
+    parser.add_argument('--deploy-window', dest='deploy_window', type=int, action='store', default=4,
+                        help='Deploy chunks buffered by the device')
+    parser.add_argument('--deploy-chunk', dest='deploy_chunk', type=int, action='store', default=1024,
+                        help='Largest deploy chunk accepted by the device')
+    parser.add_argument('--flash-rate', dest='flash_rate', type=float, action='store', default=0,
+                        help='Bytes per second stored by the device, a chunk is acknowledged once '
+                             'it is stored, 0 for no delay')
+    parser.add_argument('--error-rate', dest='error_rate', type=float, action='store', default=0,
+                        help='Probability of rejecting a deploy chunk as corrupted')
+    parser.add_argument('--no-deflate', dest='no_deflate', action='store_true', default=False,
+                        help='Refuse deflated deploys, like a device without an inflater')
+    parser.add_argument('--link-rate', dest='link_rate', metavar='baud', type=int, action='store', default=0,
+                        help='Receive no faster than a UART at the given baud rate, 0 for no limit')
+    parser.add_argument('--drop-after', dest='drop_after', metavar='chunks', type=int, action='store',
+                        default=None, help='Close the TCP connection once, after the given number of '
+                                           'deploy chunks was stored')
+    parser.add_argument('--device-id', dest='device_id', action='store', default='maple-sim-%d' % os.getpid(),
+                        help='Identity reported with the hash of the deployed script, empty to '
+                             'report none')
+    parser.add_argument('--boot-delay', dest='boot_delay', type=float, action='store', default=1,
+                        help='Seconds to wait after a client connects before booting, unless it '
+                             'sends a byte first; pyserial drops the input pending when it opens '
+                             'the port')
+    parser.add_argument('--duration', dest='duration', type=float, action='store', default=None,
+                        help='Exit after the given number of seconds and print the statistics')
+    args = parser.parse_args()
+    if not 16 <= args.message_size <= 125:
+        parser.error('--message-size must be between 16 and 125')
+    if args.functions < 0 or args.lines < 1:
+        parser.error('--functions must not be negative and --lines must be positive')
+    return args
+
+
+def generate_source(functions: int, lines: int):
+    """Generate a script and its breakpoint layout.
+
+    The global code calls every function once, so the execution walks through
+    all functions in order.
+
+    Args:
+        functions: Number of functions.
+        lines: Number of statements in each function.
+
+    Returns:
+        The source code and a list of (name, line, column, breakpoint lines)
+        tuples, the last one describes the global code.
+    """
+    source = ['var counter = 0;']
+    layout = []
+    for index in range(functions):
+        first = len(source) + 1
+        source.append('function f%d() {' % index)
+        for line in range(lines):
+            source.append('  counter += %d;' % line)
+        source.append('}')
+        layout.append(('f%d' % index, first, 1, list(range(first + 1, first + 1 + lines))))
+    calls = [1]
+    for index in range(functions):
+        source.append('f%d();' % index)
+        calls.append(len(source))
+    layout.append(('', 1, 1, calls))
+    return '\n'.join(source) + '\n', layout
+
+
+def layout_source(source: str):
+    """Breakpoint layout of a script which is not generated.
+
+    Returns:
+        A layout with the global code only, every non-empty line is a statement.
+    """
+    lines = [index + 1 for index, line in enumerate(source.splitlines()) if line.strip()]
+    return [('', 1, 1, lines or [1])]
+
+
+class Function:
+    """Byte code of a parsed function, as seen by the debugger."""
+
+    def __init__(self, byte_code_cp: int, name: str, line: int, column: int, lines: list):
+        self.byte_code_cp = byte_code_cp
+        self.name = name
+        self.line = line
+        self.column = column
+        self.lines = lines
+        self.offsets = [4 + 8 * index for index in range(len(lines))]
+
+
+class Device:
+    """A board running the MapleJS debug engine, connected through 'fd'.
+
+    The engine executes the statements of the script in a loop at the step
+    rate and stops on breakpoints, step commands and stop requests. While
+    it runs it prints output messages and parses the script again at the
+    configured rates. Deploy, execute, restart and baud rate frames of the
+    UART protocol are served as well.
+    """
+
+    def __init__(self, fd: int, args, flash: dict):
+        self.fd = fd
+        self.args = args
+        self.received = bytearray()
+        self.outbound = bytearray()
+        self.stats = collections.Counter()
+        self.flash = flash
+        self.dropped = False
+        self.acks = []
+        self.flash_done = 0
+        self.link_free = 0
+        if args.source is not None:
+            with open(args.source, 'rb') as f:
+                self.source = f.read().decode('utf-8')
+            self.layout = layout_source(self.source)
+        else:
+            self.source, self.layout = generate_source(args.functions, args.lines)
+        self.reset()
+
+    def reset(self):
+        self.functions = []
+        self.order = []
+        self.next_cp = 0x100
+        self.breakpoints = set()
+        self.parser_wait = False
+        self.waiting = False
+        self.halted = False
+        self.running = False
+        self.step_mode = None
+        self.stop_requested = False
+        self.pc = 0
+        self.current = None
+        self.eval_data = b''
+        self.eval_size = 0
+        self.output_count = 0
+
+    def write(self, data: bytes):
+        view = memoryview(data)
+        while view:
+            try:
+                written = os.write(self.fd, view)
+            except OSError:
+                # The client is gone, run() ends the connection.
+                self.dropped = True
+                return
+            view = view[written:]
+        self.stats['bytes out'] += len(data)
+
+    def flush(self):
+        if self.outbound:
+            data = bytes(self.outbound)
+            del self.outbound[:]
+            self.write(data)
+
+    def send(self, message_type: int, payload: bytes = b''):
+        self.outbound += struct.pack('<BBBBB', 0x7e, client.TARGET_DEBUGGER,
+                                     client.WEBSOCKET_BINARY_FRAME | client.WEBSOCKET_FIN_BIT,
+                                     len(payload) + 1, message_type)
+        self.outbound += payload
+        self.stats['frames out'] += 1
+
+    def send_data(self, message_type: int, end_type: int, data: bytes):
+        """Send data split into messages, the last one has 'end_type'.
+
+        Lists (end_type None) are split at entry boundaries.
+        """
+        chunk = self.args.message_size - 1
+        if end_type is None:
+            chunk -= chunk % 4
+        for start in range(0, max(len(data), 1), chunk):
+            if end_type is not None and start + chunk >= len(data):
+                message_type = end_type
+            self.send(message_type, data[start:start + chunk])
+
+    def boot(self, source: str = None):
+        """Reboot the engine, announce the debugger and parse the script."""
+        if source is not None:
+            self.source = source
+            self.layout = layout_source(source)
+        self.reset()
+        self.write(b'MapleJS simulator booting\r\n@@')
+        self.send(client.JERRY_DEBUGGER_CONFIGURATION,
+                  struct.pack('BBBB', self.args.message_size, 2, 1, client.JERRY_DEBUGGER_VERSION))
+        self.parse()
+        # The engine stops at the first statement when a client is connected.
+        self.stop_requested = True
+        self.running = True
+        self.next_step = time.monotonic()
+        self.next_output = self.next_step
+        self.next_parse = self.next_step + self.parse_interval()
+        self.stats['boots'] += 1
+
+    def parse_interval(self):
+        return 1 / self.args.parse_rate if self.args.parse_rate > 0 else float('inf')
+
+    def parse(self):
+        for function in self.functions:
+            self.send(client.JERRY_DEBUGGER_RELEASE_BYTE_CODE_CP, struct.pack('<H', function.byte_code_cp))
+
+        self.functions = []
+        for name, line, column, lines in self.layout:
+            self.functions.append(Function(self.next_cp, name, line, column, lines))
+            self.next_cp = self.next_cp + 1 if self.next_cp < 0xffff else 0x100
+
+        self.send_data(client.JERRY_DEBUGGER_SOURCE_CODE, client.JERRY_DEBUGGER_SOURCE_CODE_END,
+                       self.source.encode('utf-8'))
+        self.send_data(client.JERRY_DEBUGGER_SOURCE_CODE_NAME, client.JERRY_DEBUGGER_SOURCE_CODE_NAME_END,
+                       self.args.name.encode('utf-8'))
+        for function in self.functions:
+            if function is not self.functions[-1]:
+                self.send_data(client.JERRY_DEBUGGER_FUNCTION_NAME, client.JERRY_DEBUGGER_FUNCTION_NAME_END,
+                               function.name.encode('utf-8'))
+                self.send(client.JERRY_DEBUGGER_PARSE_FUNCTION,
+                          struct.pack('<II', function.line, function.column))
+            self.send_data(client.JERRY_DEBUGGER_BREAKPOINT_LIST, None,
+                           struct.pack('<%dI' % len(function.lines), *function.lines))
+            self.send_data(client.JERRY_DEBUGGER_BREAKPOINT_OFFSET_LIST, None,
+                           struct.pack('<%dI' % len(function.offsets), *function.offsets))
+            self.send(client.JERRY_DEBUGGER_BYTE_CODE_CP, struct.pack('<H', function.byte_code_cp))
+
+        # Global code first, then the body of the function called by each line.
+        main = self.functions[-1]
+        self.order = []
+        for index, offset in enumerate(main.offsets):
+            self.order.append((main, offset))
+            if 0 < index < len(self.functions):
+                callee = self.functions[index - 1]
+                self.order += [(callee, callee_offset) for callee_offset in callee.offsets]
+        self.pc = 0
+
+        self.stats['parses'] += 1
+        if self.parser_wait:
+            self.send(client.JERRY_DEBUGGER_WAITING_AFTER_PARSE)
+            self.waiting = True
+
+    def stop_at(self, function: Function, offset: int):
+        self.send(client.JERRY_DEBUGGER_BREAKPOINT_HIT, struct.pack('<HI', function.byte_code_cp, offset))
+        self.running = False
+        self.step_mode = None
+        self.stop_requested = False
+        self.stats['stops'] += 1
+
+    def step(self):
+        """Execute one statement, returns False if the engine stopped on it."""
+        function, offset = self.order[self.pc]
+        self.pc = (self.pc + 1) % len(self.order)
+        previous = self.current
+
+        stop = (self.stop_requested or
+                (function.byte_code_cp, offset) in self.breakpoints or
+                self.step_mode == 'step' or
+                (self.step_mode == 'next' and function in (previous, self.functions[-1])) or
+                (self.step_mode == 'finish' and function is not previous))
+        self.current = function
+        if stop:
+            self.stop_at(function, offset)
+            return False
+        self.stats['statements'] += 1
+        return True
+
+    def resume(self, step_mode: str = None):
+        self.running = True
+        self.step_mode = step_mode
+        self.next_step = time.monotonic()
+        self.next_output = max(self.next_output, self.next_step)
+        self.next_parse = max(self.next_parse, self.next_step)
+
+    def send_output(self):
+        self.output_count += 1
+        text = ('output %d ' % self.output_count).ljust(self.args.output_size - 1, '.') + '\n'
+        self.send_data(client.JERRY_DEBUGGER_OUTPUT_RESULT, client.JERRY_DEBUGGER_OUTPUT_RESULT_END,
+                       text.encode('utf-8') + bytes([client.JERRY_DEBUGGER_OUTPUT_OK]))
+        self.stats['outputs'] += 1
+
+    def send_backtrace(self, max_depth: int):
+        frames = []
+        index = (self.pc - 1) % len(self.order)
+        function, offset = self.order[index]
+        frames.append((function.byte_code_cp, offset))
+        main = self.functions[-1]
+        while len(frames) < self.args.backtrace_depth:
+            # Callers: the global code line which called the function.
+            frames.append((main.byte_code_cp, main.offsets[min(self.functions.index(function) + 1,
+                                                               len(main.offsets) - 1)]))
+        if max_depth:
+            frames = frames[:max_depth]
+        data = b''.join(struct.pack('<HI', *frame) for frame in frames)
+        chunk = (self.args.message_size - 1) // 6 * 6
+        for start in range(0, max(len(data), 1), chunk):
+            if start + chunk >= len(data):
+                self.send(client.JERRY_DEBUGGER_BACKTRACE_END, data[start:start + chunk])
+            else:
+                self.send(client.JERRY_DEBUGGER_BACKTRACE, data[start:start + chunk])
+
+    def send_eval_result(self, data: bytes):
+        expression = data[1:].decode('utf-8', 'replace')
+        subtype = client.JERRY_DEBUGGER_EVAL_OK
+        if data[0:1] == client.JERRY_DEBUGGER_EVAL_THROW.encode():
+            result, subtype = expression, client.JERRY_DEBUGGER_EVAL_ERROR
+        elif re.match(r'^[\d\s+\-*/%().]+$', expression):
+            try:
+                result = str(eval(expression, {'__builtins__': {}}))
+            except Exception as e:
+                result, subtype = type(e).__name__, client.JERRY_DEBUGGER_EVAL_ERROR
+        else:
+            result = 'undefined'
+        self.send_data(client.JERRY_DEBUGGER_EVAL_RESULT, client.JERRY_DEBUGGER_EVAL_RESULT_END,
+                       result.encode('utf-8') + bytes([subtype]))
+
+    def handle_message(self, message: bytes):
+        """Handle a debugger message of the client (type byte and payload)."""
+        message_type = message[0]
+        self.stats['messages in'] += 1
+
+        if message_type == client.JERRY_DEBUGGER_UPDATE_BREAKPOINT:
+            enable, byte_code_cp, offset = struct.unpack('<BHI', message[1:8])
+            if enable:
+                self.breakpoints.add((byte_code_cp, offset))
+            else:
+                self.breakpoints.discard((byte_code_cp, offset))
+        elif message_type == client.JERRY_DEBUGGER_PARSER_CONFIG:
+            self.parser_wait = bool(message[1])
+        elif message_type == client.JERRY_DEBUGGER_PARSER_RESUME:
+            self.waiting = False
+        elif message_type == client.JERRY_DEBUGGER_MEMSTATS:
+            used = sum(len(function.lines) for function in self.functions)
+            self.send(client.JERRY_DEBUGGER_MEMSTATS_RECEIVE,
+                      struct.pack('<5I', 1024 + 64 * used, 48 * used, len(self.source), 256, 128))
+        elif message_type == client.JERRY_DEBUGGER_STOP:
+            self.stop_requested = self.running
+        elif message_type == client.JERRY_DEBUGGER_CONTEXT_RESET:
+            self.boot()
+        elif message_type in (client.JERRY_DEBUGGER_FREE_BYTE_CODE_CP,
+                              client.JERRY_DEBUGGER_EXCEPTION_CONFIG):
+            pass
+        elif self.running:
+            # Everything else is only accepted while the engine is stopped.
+            self.stats['ignored'] += 1
+        elif message_type == client.JERRY_DEBUGGER_CONTINUE:
+            self.resume()
+        elif message_type == client.JERRY_DEBUGGER_STEP:
+            self.resume('step')
+        elif message_type == client.JERRY_DEBUGGER_NEXT:
+            self.resume('next')
+        elif message_type == client.JERRY_DEBUGGER_FINISH:
+            self.resume('finish')
+        elif message_type == client.JERRY_DEBUGGER_GET_BACKTRACE:
+            self.send_backtrace(struct.unpack('<I', message[1:5])[0])
+        elif message_type == client.JERRY_DEBUGGER_EVAL:
+            self.eval_size = struct.unpack('<I', message[1:5])[0]
+            self.eval_data = message[5:]
+        elif message_type == client.JERRY_DEBUGGER_EVAL_PART:
+            self.eval_data += message[1:]
+        else:
+            self.stats['ignored'] += 1
+
+        if message_type in (client.JERRY_DEBUGGER_EVAL, client.JERRY_DEBUGGER_EVAL_PART) \
+                and not self.running and len(self.eval_data) >= self.eval_size:
+            self.send_eval_result(self.eval_data)
+            self.eval_data = b''
+
+    def reply(self, target: int, payload: bytes):
+        self.outbound += client.construct_msg(target, payload)
+
+    def handle_deploy_chunk(self, payload: bytes):
+        """Serve the windowed deploy, see deploy_window() of the client.
+
+        The chunks are kept in 'flash', which outlives the connection, so an
+        interrupted deploy of the same file resumes at the first missing chunk.
+        """
+        op = payload[0]
+        upload = self.flash['upload']
+        if op == client.DEPLOY_BEGIN:
+            size, chunk_size, crc = struct.unpack('<IHI', payload[1:11])
+            encoding, raw_size, file_type = client.DEPLOY_RAW, size, client.DEPLOY_SCRIPT
+            if len(payload) >= 16:
+                encoding, raw_size = struct.unpack('<BI', payload[11:16])
+            if len(payload) >= 17:
+                file_type = payload[16]
+            if encoding != client.DEPLOY_RAW and (encoding != client.DEPLOY_DEFLATE or self.args.no_deflate):
+                # Keep the stored chunks, the client starts over uncompressed.
+                self.reply(client.TARGET_DEPLOY_CHUNK,
+                           struct.pack('<BBHHB', client.DEPLOY_BEGIN, 0, 0, 0, client.DEPLOY_RAW))
+                return
+            chunk_size = min(chunk_size, self.args.deploy_chunk)
+            key = (size, crc, encoding, file_type)
+            if upload is None or (upload['size'], upload['crc'], upload['encoding'], upload['type']) != key:
+                upload = {'size': size, 'crc': crc, 'encoding': encoding, 'raw size': raw_size,
+                          'type': file_type, 'chunk size': chunk_size, 'chunks': {}}
+                self.flash['upload'] = upload
+            resume = 0
+            while resume in upload['chunks']:
+                resume += 1
+            self.acks = []
+            self.reply(client.TARGET_DEPLOY_CHUNK,
+                       struct.pack('<BBHHBB', client.DEPLOY_BEGIN, self.args.deploy_window,
+                                   upload['chunk size'], resume, encoding, file_type))
+        elif op == client.DEPLOY_DATA and upload is not None:
+            seq, crc = struct.unpack('<HI', payload[1:7])
+            data = payload[7:]
+            if random.random() < self.args.error_rate or zlib.crc32(data) != crc:
+                self.stats['chunks rejected'] += 1
+                self.reply(client.TARGET_DEPLOY_CHUNK, struct.pack('<BH', client.DEPLOY_NAK, seq))
+                return
+            upload['chunks'][seq] = data
+            self.stats['chunks'] += 1
+            self.flash['chunks'] += 1
+            if self.args.tcp is not None and self.flash['chunks'] == self.args.drop_after:
+                self.dropped = True
+            # The chunk is acknowledged when the flash has written it.
+            now = time.monotonic()
+            if self.args.flash_rate > 0:
+                self.flash_done = max(now, self.flash_done) + len(payload) / self.args.flash_rate
+            else:
+                self.flash_done = now
+            self.acks.append((self.flash_done, seq))
+        elif op == client.DEPLOY_END and upload is not None:
+            chunks = upload['chunks']
+            data = b''.join(chunks[seq] for seq in sorted(chunks))
+            valid = (len(data) == upload['size'] and
+                     sorted(chunks) == list(range(len(chunks))) and
+                     zlib.crc32(data) == struct.unpack('<I', payload[1:5])[0])
+            if valid and upload['encoding'] == client.DEPLOY_DEFLATE:
+                try:
+                    data = zlib.decompress(data, -client.DEPLOY_DEFLATE_WBITS)
+                except zlib.error:
+                    data = b''
+                valid = len(data) == upload['raw size']
+            self.flash['upload'] = None
+            if valid and upload['type'] == client.DEPLOY_ASSET:
+                self.flash['assets'].append(data)
+                self.stats['assets'] += 1
+            elif valid:
+                self.flash['deployed'] = data
+                self.flash['snapshot'] = upload['type'] == client.DEPLOY_SNAPSHOT
+                self.stats['deploys'] += 1
+            else:
+                self.stats['deploy errors'] += 1
+            self.reply(client.TARGET_DEPLOY_CHUNK, struct.pack('<BB', client.DEPLOY_END, valid))
+
+    def send_acks(self, now: float):
+        """Acknowledge the stored deploy chunks, returns the time of the next one."""
+        while self.acks and self.acks[0][0] <= now:
+            self.reply(client.TARGET_DEPLOY_CHUNK, struct.pack('<BH', client.DEPLOY_ACK, self.acks.pop(0)[1]))
+        return self.acks[0][0] if self.acks else float('inf')
+
+    def handle_target(self, target: int, payload: bytes, checksum: int):
+        """Handle a construct_msg() frame of the client."""
+        valid = client.check_sum(payload, len(payload)) == checksum
+        self.stats['target frames in'] += 1
+
+        if target == client.TARGET_FILE_DEPLOY:
+            if valid:
+                self.flash['deployed'] = payload
+                self.flash['snapshot'] = False
+                self.stats['deploys'] += 1
+                self.write(b'Deploy OK, %d bytes\r\n' % len(payload))
+            else:
+                self.stats['deploy errors'] += 1
+                self.write(b'Deploy failed, checksum error\r\n')
+        elif target == client.TARGET_BAUD_RATE:
+            if valid:
+                rate = struct.unpack('<I', payload[0:4])[0]
+                accepted = rate if rate <= self.args.max_baud else 0
+                self.reply(client.TARGET_BAUD_RATE, struct.pack('<I', accepted))
+        elif target == client.TARGET_DEPLOY_CHUNK:
+            if valid:
+                self.handle_deploy_chunk(payload)
+            else:
+                # The sequence number cannot be trusted, the client resends on timeout.
+                self.stats['chunks rejected'] += 1
+        elif target == client.TARGET_DEPLOY_HASH:
+            if valid:
+                deployed = self.flash['deployed']
+                digest = hashlib.sha256(deployed).digest() if deployed is not None else bytes(32)
+                self.reply(client.TARGET_DEPLOY_HASH, digest + self.args.device_id.encode('utf-8'))
+        elif target == client.TARGET_CONFIG_DEPLOY:
+            self.flash['config'] = payload
+            self.stats['configs'] += 1
+            self.write(b'Config OK, %d bytes\r\n' % len(payload))
+        elif target == client.TARGET_FILE_EXECUTE:
+            if self.flash['snapshot']:
+                # There is no source to report, the snapshot runs without the debugger.
+                self.halted = True
+                self.running = False
+                self.write(b'Running snapshot, %d bytes\r\n' % len(self.flash['deployed']))
+            elif self.flash['deployed'] is not None:
+                self.boot(self.flash['deployed'].decode('utf-8', 'replace'))
+            else:
+                self.write(b'No script deployed\r\n')
+        elif target in (client.TARGET_DEVICE_RESTART, client.TARGET_START_DEBUGGER):
+            self.boot()
+        elif target == client.TARGET_STOP_ENGINE:
+            self.halted = True
+            self.running = False
+            self.write(b'Engine stopped\r\n')
+        else:
+            self.stats['ignored'] += 1
+
+    def receive(self, data: bytes):
+        buffer = self.received
+        buffer += data
+        self.stats['bytes in'] += len(data)
+        pos = 0
+        while True:
+            loc = buffer.find(b'\x7e', pos)
+            if loc == -1:
+                pos = len(buffer)
+                break
+            if len(buffer) < loc + 4:
+                pos = loc
+                break
+
+            target = buffer[loc + 1]
+            if target == client.TARGET_DEBUGGER:
+                # 82, 0x80 + size, mask [4], message
+                size = buffer[loc + 3] & 0x7f
+                end = loc + 8 + size
+                if len(buffer) < end:
+                    pos = loc
+                    break
+                mask = buffer[loc + 4:loc + 8]
+                message = bytes(byte ^ mask[index % 4] for index, byte in enumerate(buffer[loc + 8:end]))
+                if message:
+                    self.handle_message(message)
+            elif target in TARGETS:
+                # size [2], payload, checksum
+                size = buffer[loc + 2] | (buffer[loc + 3] << 8)
+                end = loc + 4 + size + 1
+                if len(buffer) < end:
+                    pos = loc
+                    break
+                self.handle_target(target, bytes(buffer[loc + 4:end - 1]), buffer[end - 1])
+            else:
+                end = loc + 1
+            pos = end
+        del buffer[:pos]
+
+    def tick(self, now: float):
+        """Run the engine up to 'now', returns the time of the next event."""
+        if not self.running or self.waiting or self.halted:
+            return float('inf')
+
+        while self.next_step <= now:
+            self.next_step += 1 / self.args.step_rate
+            if not self.step():
+                return float('inf')
+
+        if self.args.output_rate > 0:
+            while self.next_output <= now:
+                self.send_output()
+                self.next_output += 1 / self.args.output_rate
+        else:
+            self.next_output = float('inf')
+
+        if self.next_parse <= now:
+            self.parse()
+            self.next_parse = now + self.parse_interval()
+
+        # Do not try to catch up after a long stop.
+        self.next_step = max(self.next_step, now - 1)
+        self.next_output = max(self.next_output, now - 1)
+        return min(self.next_step, self.next_output, self.next_parse)
+
+    def run(self, deadline: float, boot_delay: float = 0):
+        """Serve the link until it is closed or 'deadline' passes.
+
+        Like a board that is powered on when the client is ready, the engine
+        boots on the first byte of the client or after 'boot_delay' seconds,
+        whichever comes first.
+
+        Returns:
+            False if the client closed the link.
+        """
+        boot_time = time.monotonic() + boot_delay
+        booted = False
+        while True:
+            now = time.monotonic()
+            if now >= deadline:
+                return True
+
+            if not booted and now >= boot_time:
+                self.boot()
+                booted = True
+
+            next_event = min(self.tick(now), self.send_acks(now))
+            if not booted:
+                next_event = min(next_event, boot_time)
+            self.flush()
+            if self.dropped:
+                return False
+            # A throttled link delivers the next bytes when the previous
+            # ones have been transmitted.
+            fds = [self.fd]
+            if now < self.link_free:
+                next_event = min(next_event, self.link_free)
+                fds = []
+            timeout = max(0, min(next_event, deadline) - time.monotonic())
+            if timeout == float('inf'):
+                timeout = None
+
+            if select.select(fds, [], [], timeout)[0]:
+                try:
+                    # 10 ms of the throttled link at a time.
+                    data = os.read(self.fd, max(self.args.link_rate // 1000, 1) if self.args.link_rate else 65536)
+                except OSError:
+                    data = b''
+                if not data:
+                    return False
+                if self.args.link_rate:
+                    self.link_free = max(now, self.link_free) + len(data) * 10 / self.args.link_rate
+                boots = self.stats['boots']
+                self.receive(data)
+                # A start debugger or restart frame boots the engine itself.
+                if not booted and self.stats['boots'] == boots:
+                    self.boot()
+                booted = True
+                self.flush()
+                if self.dropped:
+                    return False
+
+
+def print_stats(stats: collections.Counter, elapsed: float):
+    print('Simulated for %.1f seconds' % elapsed)
+    for name in sorted(stats):
+        print('  %-18s %10d  %10.1f/s' % (name, stats[name], stats[name] / elapsed))
+
+
+def main():
+    args = parse_argument()
+    devices = []
+    # Storage of the device, it survives the connections.
+    flash = {'deployed': None, 'snapshot': False, 'assets': [], 'upload': None, 'chunks': 0, 'config': None}
+    start = time.monotonic()
+    deadline = start + args.duration if args.duration is not None else float('inf')
+
+    try:
+        if args.tcp is None:
+            master, slave = pty.openpty()
+            tty.setraw(master)
+            tty.setraw(slave)
+            # Print the port first, scripts read it from the first line.
+            print(os.ttyname(slave), flush=True)
+            # The slave stays open here, so a client can close and reopen it.
+            devices.append(Device(master, args, flash))
+            devices[-1].run(deadline, args.boot_delay)
+        else:
+            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server.bind(('', args.tcp))
+            server.listen(1)
+            print('Listening on TCP port %d' % args.tcp, flush=True)
+            while time.monotonic() < deadline:
+                timeout = None if deadline == float('inf') else deadline - time.monotonic()
+                if not select.select([server], [], [], timeout)[0]:
+                    break
+                connection, peer = server.accept()
+                print('Client %s connected' % (peer,), flush=True)
+                devices.append(Device(connection.fileno(), args, flash))
+                try:
+                    devices[-1].run(deadline, args.boot_delay)
+                finally:
+                    connection.close()
+                print('Client %s disconnected' % (peer,), flush=True)
+    except KeyboardInterrupt:
+        pass
+
+    print_stats(sum((device.stats for device in devices), collections.Counter()),
+                time.monotonic() - start)
+
+
+if __name__ == '__main__':
+    main()